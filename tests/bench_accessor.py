@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Accessor benchmarks against local stand-in servers.
+
+Serves a copy of tests/data/xsrepo plus a random payload.bin of --size MiB
+from the HTTP and FTP stand-ins, then times openAddress() reads, access()
+round trips, writeFile() copies and Repository discovery through each
+accessor.  Every scheme runs once per fault profile (clean, latency,
+bandwidth, lossy), and the table reports the median of --repeat runs with
+the number that failed:
+
+    PYTHONPATH=. python tests/bench_accessor.py [--size MiB] [--repeat N]
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import xcp.accessor
+import xcp.logger
+from xcp import repository
+
+from standin_servers import Faults, FTPStandIn, HTTPStandIn
+
+PROFILES = {
+    'clean': {},
+    'latency': {'latency': 0.02},
+    'bandwidth': {'bandwidth': 20 * 1024 * 1024},
+    'lossy': {'drop_rate': 0.05},
+}
+
+SERVERS = {'http': HTTPStandIn, 'ftp': FTPStandIn}
+
+def make_tree(size):
+    root = tempfile.mkdtemp(prefix="bench-accessor")
+    tree = os.path.join(root, "repo")
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "data", "xsrepo"), tree)
+    rand = random.Random(0)
+    with open(os.path.join(tree, "payload.bin"), "wb") as f:
+        for _ in range(size):
+            f.write(''.join(chr(rand.getrandbits(8)) for _ in range(1024)) * 1024)
+    return root, tree
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+def timed(func, repeat):
+    """Run func repeat times, returning (median seconds, failures)."""
+    times = []
+    failures = 0
+    for _ in range(repeat):
+        start = time.time()
+        try:
+            ok = func()
+        except Exception:
+            ok = False
+        if ok is False:
+            failures += 1
+        else:
+            times.append(time.time() - start)
+    return median(times), failures
+
+def bench(access, size, repeat, out_dir):
+    def read():
+        f = access.openAddress("payload.bin")
+        if not f:
+            return False
+        while f.read(1024 * 1024):
+            pass
+        f.close()
+
+    def probe():
+        for name in ("XS-REPOSITORY", "XS-PACKAGES", "no_such_file") * 5:
+            access.access(name)
+
+    out = xcp.accessor.FileAccessor("file://%s/" % out_dir, False)
+    def write():
+        f = access.openAddress("payload.bin")
+        if not f:
+            return False
+        out.writeFile(f, "payload.bin")
+        f.close()
+
+    def discover():
+        return len(repository.BaseRepository.findRepositories(access)) == 1
+
+    access.start()
+    try:
+        results = []
+        for name, func, scale, unit in (
+                ("read", read, size, "MiB/s"),
+                ("access", probe, 15, "ms/call"),
+                ("writeFile", write, size, "MiB/s"),
+                ("discover", discover, 1, "ms")):
+            elapsed, failures = timed(func, repeat)
+            if elapsed is None:
+                value = None
+            elif unit == "MiB/s":
+                value = scale / elapsed
+            else:
+                value = elapsed * 1000 / scale
+            results.append((name, value, unit, failures))
+        return results
+    finally:
+        access.finish()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=16,
+                        help="payload size in MiB")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--profile", action="append", choices=sorted(PROFILES),
+                        help="fault profiles to run (default: all)")
+    args = parser.parse_args(argv)
+    xcp.logger.logToStderr(logging.WARNING)
+
+    root, tree = make_tree(args.size)
+    out_dir = os.path.join(root, "out")
+    os.mkdir(out_dir)
+    try:
+        runs = [("file", "clean", None)]
+        for scheme in sorted(SERVERS):
+            for profile in args.profile or sorted(PROFILES):
+                runs.append((scheme, profile, Faults(**PROFILES[profile])))
+
+        print "%-5s %-10s %-10s %12s %-8s %s" % (
+            "", "profile", "operation", "result", "unit", "failures")
+        for scheme, profile, faults in runs:
+            server = None
+            if scheme == "file":
+                url = "file://%s/" % tree
+            else:
+                server = SERVERS[scheme](tree, faults).start()
+                url = server.url
+            try:
+                access = xcp.accessor.createAccessor(url, True)
+                for name, value, unit, failures in bench(access, args.size,
+                                                   args.repeat, out_dir):
+                    print "%-5s %-10s %-10s %12s %-8s %d" % (
+                        scheme, profile, name,
+                        "-" if value is None else "%.1f" % value, unit, failures)
+            finally:
+                if server:
+                    server.stop()
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Repository catalog benchmark.
+
+Writes an XS-PACKAGES of --packages entries, mostly rpm with some
+driver-rpm, tbz2 and firmware packages, and loads it through a Repository.
+Prints the time to load and the growth of the resident set while the
+package objects are alive:
+
+    PYTHONPATH=. python tests/bench_repository.py [--packages N] [--repeat N]
+"""
+
+import argparse
+import gc
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import xcp.accessor
+from xcp import repository
+
+KERNELS = ["4.19.0+1", "4.19.0+2", "4.19.19-7.0.13.1.xs8"]
+OPTIONS = ["", "-i", "--nodeps"]
+
+def make_tree(count):
+    root = tempfile.mkdtemp(prefix="bench-repository")
+    rand = random.Random(0)
+    with open(os.path.join(root, "XS-REPOSITORY"), "w") as f:
+        f.write('<repository originator="xcp" name="main" product="XCP-ng" '
+                'version="8.2.1" build="1"><description>Benchmark</description>'
+                '</repository>\n')
+    with open(os.path.join(root, "XS-PACKAGES"), "w") as f:
+        f.write("<packages>\n")
+        for i in range(count):
+            md5 = "%032x" % rand.getrandbits(128)
+            size = rand.randint(1024, 64 * 1024 * 1024)
+            kind = rand.random()
+            if kind < 0.7:
+                f.write('<package type="rpm" label="pkg%d" size="%d" md5="%s" '
+                        'optional="false" options="%s">packages/pkg%d-1.0-1.x86_64.rpm'
+                        '</package>\n' % (i, size, md5, rand.choice(OPTIONS), i))
+            elif kind < 0.9:
+                f.write('<package type="driver-rpm" label="drv%d" size="%d" md5="%s" '
+                        'kernel="%s" options="%s">packages/drv%d-1.0-1.x86_64.rpm'
+                        '</package>\n' % (i, size, md5, rand.choice(KERNELS),
+                                          rand.choice(OPTIONS), i))
+            elif kind < 0.95:
+                f.write('<package type="tbz2" label="arc%d" size="%d" md5="%s" '
+                        'root="/">packages/arc%d.tar.bz2</package>\n'
+                        % (i, size, md5, i))
+            else:
+                f.write('<package type="firmware" label="fw%d" size="%d" md5="%s">'
+                        'packages/fw%d.bin</package>\n' % (i, size, md5, i))
+        f.write("</packages>\n")
+    return root
+
+def rss():
+    """Return the resident set size of the process in bytes."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    root = make_tree(args.packages)
+    try:
+        access = xcp.accessor.createAccessor("file://%s/" % root, True)
+        times = []
+        for _ in range(args.repeat):
+            gc.collect()
+            start = time.time()
+            repository.Repository(access, "")
+            times.append(time.time() - start)
+
+        gc.collect()
+        before = rss()
+        repo = repository.Repository(access, "")
+        gc.collect()
+        held = rss() - before
+
+        print "packages      %d" % len(repo.packages)
+        print "load time     %.2f s (best of %d)" % (min(times), args.repeat)
+        print "memory held   %.1f MiB (%d bytes/package)" % (
+            held / (1024.0 * 1024), held / len(repo.packages))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
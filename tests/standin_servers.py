@@ -0,0 +1,282 @@
+"""Local stand-in servers for exercising accessors over the network.
+
+The servers listen on a loopback port and serve a directory.  A Faults
+object can make them slow (per request latency), bandwidth-capped, or drop
+a fraction of the requests; its random source is seeded, so that a given
+profile always drops the same requests.
+"""
+
+import BaseHTTPServer
+import os
+import random
+import SimpleHTTPServer
+import socket
+import SocketServer
+import threading
+import time
+
+class Faults(object):
+    """Fault injection profile shared by the requests of a stand-in."""
+
+    def __init__(self, latency=0, bandwidth=None, drop_rate=0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Faults latency=%s bandwidth=%s drop_rate=%s>" % (
+            self.latency, self.bandwidth, self.drop_rate)
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def drop(self):
+        if not self.drop_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.drop_rate
+
+    def copy(self, infile, outfile, bufsize=16 * 1024):
+        """Copy infile to outfile, keeping under the bandwidth cap."""
+        start = time.time()
+        sent = 0
+        while True:
+            data = infile.read(bufsize)
+            if not data:
+                break
+            outfile.write(data)
+            sent += len(data)
+            if self.bandwidth:
+                ahead = float(sent) / self.bandwidth - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+class _StandIn(object):
+    scheme = None
+
+    @property
+    def url(self):
+        return "%s://127.0.0.1:%d/" % (self.scheme, self.server_address[1])
+
+    def path(self, name):
+        return os.path.join(self.root, os.path.normpath("/" + name).lstrip("/"))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+class _HTTPHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return self.server.path(os.path.relpath(path, os.getcwd()))
+
+    def do_GET(self):
+        self.server.faults.delay()
+        if self.server.faults.drop():
+            self.close_connection = 1
+            return
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def copyfile(self, source, outputfile):
+        self.server.faults.copy(source, outputfile)
+
+    def log_message(self, *args):
+        pass
+
+class HTTPStandIn(_StandIn, SocketServer.ThreadingMixIn,
+                  BaseHTTPServer.HTTPServer):
+    """Serve the directory 'root' over HTTP on a loopback port."""
+
+    scheme = "http"
+    daemon_threads = True
+
+    def __init__(self, root, faults=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _HTTPHandler)
+        self.root = os.path.abspath(root)
+        self.faults = faults or Faults()
+        self.thread = None
+
+class _FTPHandler(SocketServer.StreamRequestHandler):
+    """Just enough of RFC 959 for ftplib, in passive mode."""
+
+    def reply(self, line):
+        self.wfile.write(line + "\r\n")
+
+    def handle(self):
+        self.cwd = "/"
+        self.pasv = None
+        self.reply("220 stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd, _, arg = line.rstrip("\r\n").partition(" ")
+            self.server.faults.delay()
+            handler = getattr(self, "ftp_" + cmd.upper(), None)
+            if handler is None:
+                self.reply("502 %s not implemented" % cmd)
+            elif handler(arg) is False:
+                break
+        if self.pasv:
+            self.pasv.close()
+
+    def local(self, arg):
+        return self.server.path(os.path.join(self.cwd, arg))
+
+    def data_connection(self):
+        conn, _ = self.pasv.accept()
+        self.pasv.close()
+        self.pasv = None
+        return conn
+
+    def ftp_USER(self, _):
+        self.reply("331 any password will do")
+
+    def ftp_PASS(self, _):
+        self.reply("230 logged in")
+
+    def ftp_SYST(self, _):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_NOOP(self, _):
+        self.reply("200 ok")
+
+    def ftp_TYPE(self, _):
+        self.reply("200 ok")
+
+    def ftp_PWD(self, _):
+        self.reply('257 "%s"' % self.cwd)
+
+    def ftp_CWD(self, arg):
+        path = os.path.normpath(os.path.join(self.cwd, arg))
+        if not os.path.isdir(self.server.path(path)):
+            self.reply("550 no such directory")
+            return
+        self.cwd = path
+        self.reply("250 ok")
+
+    def ftp_PASV(self, _):
+        if self.pasv:
+            self.pasv.close()
+        self.pasv = socket.socket()
+        self.pasv.bind(("127.0.0.1", 0))
+        self.pasv.listen(1)
+        port = self.pasv.getsockname()[1]
+        self.reply("227 Entering Passive Mode (127,0,0,1,%d,%d)" %
+                   (port >> 8, port & 0xff))
+
+    def ftp_SIZE(self, arg):
+        path = self.local(arg)
+        if not os.path.isfile(path):
+            self.reply("550 no such file")
+            return
+        self.reply("213 %d" % os.path.getsize(path))
+
+    def ftp_NLST(self, arg):
+        path = self.local(arg)
+        if not os.path.isdir(path):
+            self.reply("550 no such directory")
+            return
+        self.reply("150 listing")
+        conn = self.data_connection()
+        for name in sorted(os.listdir(path)):
+            conn.sendall(os.path.join(arg, name) + "\r\n")
+        conn.close()
+        self.reply("226 done")
+
+    def ftp_RETR(self, arg):
+        path = self.local(arg)
+        if not os.path.isfile(path):
+            self.reply("550 no such file")
+            return
+        self.reply("150 sending")
+        conn = self.data_connection()
+        if self.server.faults.drop():
+            conn.close()
+            self.reply("426 connection closed; transfer aborted")
+            return
+        out = conn.makefile("wb")
+        with open(path, "rb") as f:
+            self.server.faults.copy(f, out)
+        out.close()
+        conn.close()
+        self.reply("226 done")
+
+    def ftp_STOR(self, arg):
+        self.reply("150 receiving")
+        conn = self.data_connection()
+        with open(self.local(arg), "wb") as f:
+            while True:
+                data = conn.recv(64 * 1024)
+                if not data:
+                    break
+                f.write(data)
+        conn.close()
+        self.reply("226 done")
+
+    def ftp_MKD(self, arg):
+        path = self.local(arg)
+        if os.path.exists(path):
+            self.reply("550 already exists")
+            return
+        os.mkdir(path)
+        self.reply('257 "%s" created' % arg)
+
+    def ftp_RMD(self, arg):
+        try:
+            os.rmdir(self.local(arg))
+        except OSError as e:
+            self.reply("550 %s" % e.strerror)
+            return
+        self.reply("250 ok")
+
+    def ftp_DELE(self, arg):
+        path = self.local(arg)
+        if not os.path.isfile(path):
+            self.reply("550 no such file")
+            return
+        os.unlink(path)
+        self.reply("250 ok")
+
+    def ftp_RNFR(self, arg):
+        self.rename_from = self.local(arg)
+        if not os.path.exists(self.rename_from):
+            self.reply("550 no such file")
+            return
+        self.reply("350 ready for RNTO")
+
+    def ftp_RNTO(self, arg):
+        try:
+            os.rename(self.rename_from, self.local(arg))
+        except OSError as e:
+            self.reply("550 %s" % e.strerror)
+            return
+        self.reply("250 ok")
+
+    def ftp_QUIT(self, _):
+        self.reply("221 bye")
+        return False
+
+class FTPStandIn(_StandIn, SocketServer.ThreadingTCPServer):
+    """Serve the directory 'root' over FTP on a loopback port."""
+
+    scheme = "ftp"
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, faults=None):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 _FTPHandler)
+        self.root = os.path.abspath(root)
+        self.faults = faults or Faults()
+        self.thread = None
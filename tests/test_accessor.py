@@ -1,7 +1,16 @@
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import time
 import unittest
+from mock import patch
 
 import xcp.accessor
 
+from standin_servers import Faults, FTPStandIn, HTTPStandIn
+
 class TestAccessor(unittest.TestCase):
     def test_http(self):
         raise unittest.SkipTest("comment out if you really mean it")
@@ -19,3 +28,309 @@ class TestAccessor(unittest.TestCase):
         self.assertFalse(a.access('no_such_file'))
         self.assertEqual(a.lastError, 404)
         a.finish()
+
+    def test_prefetch(self):
+        a = xcp.accessor.createAccessor("file://tests/data/repo/", True)
+        a.start()
+        data = dict(a.prefetch(['.treeinfo', 'XS-REPOSITORY', 'no_such_file']))
+        a.finish()
+        self.assertEqual(data['XS-REPOSITORY'],
+                         open('tests/data/repo/XS-REPOSITORY').read())
+        self.assertTrue(data['.treeinfo'].startswith('[platform]'))
+        self.assertIsNone(data['no_such_file'])
+
+    def test_fetch_many(self):
+        tmpdir = tempfile.mkdtemp(prefix="testaccessor")
+        try:
+            a = xcp.accessor.createAccessor("file://tests/data/repo/", True)
+            a.start()
+            done = dict(a.fetch_many(['.treeinfo', 'repodata/repomd.xml',
+                                      'no_such_file', '../repo/.treeinfo',
+                                      os.path.abspath('tests/data/repo/.treeinfo')],
+                                     os.path.join(tmpdir, 'dest'), workers=2))
+            a.finish()
+            self.assertEqual(done, {'.treeinfo': True,
+                                    'repodata/repomd.xml': True,
+                                    'no_such_file': False,
+                                    '../repo/.treeinfo': False,
+                                    os.path.abspath('tests/data/repo/.treeinfo'): False})
+            self.assertEqual(os.listdir(tmpdir), ['dest'])
+            self.assertEqual(open(os.path.join(tmpdir, 'dest/repodata/repomd.xml')).read(),
+                             open('tests/data/repo/repodata/repomd.xml').read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestWriteFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testaccessor")
+        self.data = ''.join(chr(i % 251) for i in range(3 * 1024 * 1024 + 17))
+        self.src = os.path.join(self.tmpdir, "src")
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.a = xcp.accessor.createAccessor("file://%s/" % self.tmpdir, False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_copy(self, in_fh, expected):
+        self.a.writeFile(in_fh, "dst")
+        with open(os.path.join(self.tmpdir, "dst"), 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_sendfile(self):
+        with patch("xcp.accessor._bufferedCopy") as buffered_mock:
+            with open(self.src, 'rb') as in_fh:
+                self.check_copy(in_fh, self.data)
+            # only sought
+            in_fh = self.a.openAddress("src")
+            in_fh.seek(10)
+            self.check_copy(in_fh, self.data[10:])
+            in_fh.close()
+        self.assertFalse(buffered_mock.called)
+
+    def test_read_ahead(self):
+        # data already consumed by the caller must not be copied, nor data
+        # buffered by the file object skipped
+        with open(self.src, 'rb') as in_fh:
+            in_fh.read(10)
+            self.assertIsNone(xcp.accessor._sendfileCopy(in_fh, open(os.devnull, 'wb')))
+            self.check_copy(in_fh, self.data[10:])
+        with open(self.src, 'rb') as in_fh:
+            in_fh.next()
+            self.assertIsNone(xcp.accessor._sendfileCopy(in_fh, open(os.devnull, 'wb')))
+        in_fh = self.a.openAddress("src")
+        line = in_fh.next()
+        self.assertIsNone(xcp.accessor._sendfileCopy(in_fh, open(os.devnull, 'wb')))
+        self.check_copy(in_fh, self.data[len(line):])
+        in_fh.close()
+
+    def test_readinto(self):
+        with patch("xcp.accessor._sendfile", None), open(self.src, 'rb') as in_fh:
+            self.check_copy(in_fh, self.data)
+
+    def test_read(self):
+        self.check_copy(StringIO.StringIO(self.data), self.data)
+
+class TestTransferStats(unittest.TestCase):
+    def test_file(self):
+        a = xcp.accessor.createAccessor("file://tests/data/repo/", True)
+        a.start()
+        f = a.openAddress('.treeinfo')
+        lines = [line for line in f]
+        f.close()
+        self.assertFalse(a.access('no_such_file'))
+        with patch.object(a, 'log_stats', True), \
+             patch("xcp.accessor.logger.info") as info_mock:
+            a.finish()
+        self.assertIn("transfer statistics", info_mock.call_args[0][0])
+
+        stats = a.stats.snapshot()
+        self.assertEqual(stats['opens'], 1)
+        self.assertEqual(stats['transfers'], 1)
+        self.assertEqual(stats['bytes'], sum(len(line) for line in lines))
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['error_codes'], {404: 1})
+        self.assertEqual(sum(n for _, n in stats['ttfb_histogram']), 1)
+        self.assertIsNone(stats['ttfb_histogram'][-1][0])
+
+    def test_sendfile(self):
+        a = xcp.accessor.createAccessor("file://tests/data/repo/", True)
+        tmpdir = tempfile.mkdtemp(prefix="testaccessor")
+        try:
+            out = xcp.accessor.createAccessor("file://%s/" % tmpdir, False)
+            in_fh = a.openAddress('.treeinfo')
+            out.writeFile(in_fh, 'copy')
+            in_fh.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(a.stats.snapshot()['bytes'],
+                         os.path.getsize('tests/data/repo/.treeinfo'))
+
+class TestMirrorAccessor(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testaccessor")
+        self.addresses = []
+        for i in range(3):
+            d = os.path.join(self.tmpdir, str(i))
+            shutil.copytree("tests/data/repo", d)
+            self.addresses.append("file://%s/" % d)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_create(self):
+        a = xcp.accessor.createAccessor(self.addresses, True)
+        self.assertIsInstance(a, xcp.accessor.MirrorAccessor)
+        self.assertEqual(len(a.mirrors), 3)
+
+    def test_missing_on_one_mirror(self):
+        os.unlink(os.path.join(self.tmpdir, "0", "XS-REPOSITORY"))
+        a = xcp.accessor.MirrorAccessor(self.addresses, True)
+        a.start()
+        self.assertTrue(a.access("XS-REPOSITORY"))
+        self.assertFalse(a.access("no_such_file"))
+        self.assertEqual(a.lastError, 404)
+        a.finish()
+
+    def test_failover(self):
+        a = xcp.accessor.MirrorAccessor(self.addresses, True, probe = None)
+        a.start()
+        broken = a.mirrors[0]
+        with patch.object(broken, 'openAddress', side_effect=IOError("down")):
+            self.assertTrue(a.access(".treeinfo"))
+            self.assertEqual(broken.openAddress.call_count, 1)
+            self.assertTrue(a.access(".treeinfo"))
+            # skipped until retry_interval elapses
+            self.assertEqual(broken.openAddress.call_count, 1)
+        self.assertIsNot(a.ranking()[0], broken)
+        a.finish()
+
+    def test_stalled_mirror(self):
+        # accepts connections but never answers
+        stalled = socket.socket()
+        stalled.bind(("127.0.0.1", 0))
+        stalled.listen(5)
+        try:
+            addresses = ["http://127.0.0.1:%d/" % stalled.getsockname()[1]]
+            with patch.object(xcp.accessor.MirrorAccessor, 'timeout', 0.2):
+                a = xcp.accessor.MirrorAccessor(addresses + self.addresses[:1], True,
+                                                verify = ())
+            start = time.time()
+            a.start()
+            self.assertLess(time.time() - start, 2)
+            self.assertIs(a.ranking()[-1], a.mirrors[0])
+            self.assertTrue(a.access(".treeinfo"))
+            a.finish()
+        finally:
+            stalled.close()
+
+    def test_failover_mid_read(self):
+        contents = open("tests/data/repo/XS-REPOSITORY").read()
+        class Stalling(object):
+            def __init__(self):
+                self.data = StringIO.StringIO(contents)
+            def read(self, size = -1):
+                if self.data.tell() > 0:
+                    raise socket.timeout("timed out")
+                return self.data.read(10)
+            def close(self):
+                pass
+        a = xcp.accessor.MirrorAccessor(self.addresses, True, probe = None)
+        a.start()
+        broken = a.mirrors[0]
+        with patch.object(broken, 'openAddress', return_value=Stalling()):
+            f = a.openAddress("XS-REPOSITORY")
+            self.assertEqual(f.read(), contents[:10])
+            self.assertEqual(f.read(), contents[10:])
+            f.close()
+        self.assertIsNot(a.ranking()[0], broken)
+        a.finish()
+
+    def test_probe_ranking(self):
+        os.unlink(os.path.join(self.tmpdir, "0", ".treeinfo"))
+        a = xcp.accessor.MirrorAccessor(self.addresses, True)
+        a.start()
+        self.assertIs(a.ranking()[-1], a.mirrors[0])
+        a.finish()
+
+    def test_collapse(self):
+        a = xcp.accessor.MirrorAccessor(self.addresses, True, probe = None)
+        fast = a.ranking()[0]
+        a._transferDone(fast, 10 * 1024 * 1024, 1.0)
+        self.assertIs(a.ranking()[0], fast)
+        for _ in range(5):
+            a._transferDone(fast, 1024 * 1024, 10.0)
+        self.assertIsNot(a.ranking()[0], fast)
+
+    def test_consistency(self):
+        with open(os.path.join(self.tmpdir, "1", "XS-REPOSITORY"), 'a') as f:
+            f.write("\n")
+        a = xcp.accessor.MirrorAccessor(self.addresses, True,
+                                        verify = ["XS-REPOSITORY", ".treeinfo"])
+        a.start()
+        self.assertEqual(a.usable(), [a.mirrors[0], a.mirrors[2]])
+        a.finish()
+
+    def test_default_verify(self):
+        with open(os.path.join(self.tmpdir, "2", "XS-REPOSITORY"), 'a') as f:
+            f.write("\n")
+        a = xcp.accessor.MirrorAccessor(self.addresses, True)
+        a.start()
+        self.assertEqual(a.usable(), a.mirrors[:2])
+        a.finish()
+
+        # exclusions only last for the session
+        shutil.copy(os.path.join(self.tmpdir, "0", "XS-REPOSITORY"),
+                    os.path.join(self.tmpdir, "2", "XS-REPOSITORY"))
+        a.start()
+        self.assertEqual(a.usable(), a.mirrors)
+        a.finish()
+
+    def test_no_usable_mirror(self):
+        a = xcp.accessor.MirrorAccessor(self.addresses, True)
+        for mirror in a.mirrors:
+            mirror.start = lambda: 1 / 0
+        with self.assertRaises(IOError):
+            a.start()
+        self.assertEqual(a.lastError, 500)
+        self.assertEqual(a.start_count, 0)
+        self.assertFalse(a.access(".treeinfo"))
+        self.assertEqual(a.lastError, 500)
+
+class TestStandInServers(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testaccessor")
+        self.root = os.path.join(self.tmpdir, "repo")
+        shutil.copytree("tests/data/repo", self.root)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, cls, faults=None):
+        server = cls(self.root, faults).start()
+        self.servers.append(server)
+        return server
+
+    def test_ftp(self):
+        server = self.serve(FTPStandIn)
+        a = xcp.accessor.createAccessor(server.url, False)
+        a.start()
+        self.assertTrue(a.access('.treeinfo'))
+        self.assertTrue(a.access('repodata/repomd.xml'))
+        self.assertFalse(a.access('no_such_file'))
+        self.assertFalse(a.openAddress('no_such_file'))
+        self.assertEqual(a.lastError, 404)
+        f = a.openAddress('XS-REPOSITORY')
+        self.assertEqual(f.read(), open('tests/data/repo/XS-REPOSITORY').read())
+        f.close()
+        a.writeFile(StringIO.StringIO("uploaded"), 'new_file')
+        self.assertTrue(a.access('new_file'))
+        a.finish()
+        self.assertEqual(open(os.path.join(self.root, 'new_file')).read(), "uploaded")
+
+    def test_http(self):
+        server = self.serve(HTTPStandIn)
+        a = xcp.accessor.createAccessor(server.url, True)
+        a.start()
+        self.assertTrue(a.access('.treeinfo'))
+        self.assertFalse(a.access('no_such_file'))
+        self.assertEqual(a.lastError, 404)
+        a.finish()
+
+    def test_latency(self):
+        server = self.serve(HTTPStandIn, Faults(latency=0.05))
+        a = xcp.accessor.createAccessor(server.url, True)
+        f = a.openAddress('.treeinfo')
+        self.assertTrue(f.read())
+        f.close()
+        hist = a.stats.snapshot()['ttfb_histogram']
+        self.assertEqual(sum(n for _, n in hist), 1)
+        self.assertEqual(sum(n for bound, n in hist if bound is None or bound >= 50), 1)
+
+    def test_drop(self):
+        server = self.serve(HTTPStandIn, Faults(drop_rate=1))
+        a = xcp.accessor.createAccessor(server.url, True)
+        self.assertFalse(a.access('.treeinfo'))
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+import unittest
+from mock import patch
+
+import xcp.accessor
+from xcp import mount
+
+@patch("xcp.mount.umount")
+@patch("xcp.mount.mount")
+class TestMountRegistry(unittest.TestCase):
+    def test_shared(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry()
+        mp1 = registry.acquire("server:/export", "nfs", ["ro"])
+        mp2 = registry.acquire("server:/export", "nfs", ["ro"])
+        self.assertEqual(mp1, mp2)
+        mount_mock.assert_called_once_with("server:/export", mp1, ["ro"], "nfs")
+
+        other = registry.acquire("server:/export", "nfs", ["rw"])
+        self.assertNotEqual(other, mp1)
+        registry.release(other)
+
+        registry.release(mp1)
+        self.assertTrue(os.path.isdir(mp1))
+        registry.release(mp2)
+        self.assertFalse(os.path.exists(mp1))
+        umount_mock.assert_any_call(mp1)
+        self.assertEqual(umount_mock.call_count, 2)
+
+    def test_mount_failure(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry()
+        mount_mock.side_effect = mount.MountException
+        with self.assertRaises(mount.MountException):
+            registry.acquire("/dev/sr0", "iso9660")
+        self.assertEqual(registry.mounts, {})
+
+    def test_idle_timeout(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry(idle_timeout = 0.1)
+        mp = registry.acquire("/dev/sr0", "iso9660")
+        registry.release(mp)
+        # reused while idle
+        self.assertEqual(registry.acquire("/dev/sr0", "iso9660"), mp)
+        registry.release(mp)
+        self.assertFalse(umount_mock.called)
+        time.sleep(0.3)
+        umount_mock.assert_called_once_with(mp)
+        self.assertFalse(os.path.exists(mp))
+
+    def test_slow_mount(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry()
+        started = threading.Event()
+        unblock = threading.Event()
+        def slow_mount(source, *args):
+            if source == "/dev/sr0":
+                started.set()
+                unblock.wait(5)
+        mount_mock.side_effect = slow_mount
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            registry.acquire("/dev/sr0", "iso9660"))) for _ in range(2)]
+        for t in threads:
+            t.start()
+        self.assertTrue(started.wait(5))
+        # other sources are not held up by the mount in progress
+        other = registry.acquire("/dev/sr1", "iso9660")
+        self.assertFalse(unblock.is_set())
+        unblock.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(mount_mock.call_count, 2)
+        for mp in results + [other]:
+            registry.release(mp)
+        self.assertEqual(registry.mounts, {})
+
+    def test_expire_failure(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry(idle_timeout = 0.05)
+        mp = registry.acquire("/dev/sr0", "iso9660")
+        umount_mock.side_effect = OSError("busy")
+        with patch("xcp.mount.logger.error") as error_mock:
+            registry.release(mp)
+            time.sleep(0.3)
+        self.assertIn(mp, error_mock.call_args[0][0])
+        os.rmdir(mp)
+
+    def test_flush(self, mount_mock, umount_mock):
+        registry = mount.MountRegistry(idle_timeout = 60)
+        idle = registry.acquire("/dev/sr0", "iso9660")
+        registry.release(idle)
+        busy = registry.acquire("/dev/sr1", "iso9660")
+        registry.flush()
+        umount_mock.assert_called_once_with(idle)
+        registry.release(busy)
+
+    def test_accessors(self, mount_mock, umount_mock):
+        a1 = xcp.accessor.NFSAccessor("nfs://server:/export", True)
+        a2 = xcp.accessor.NFSAccessor("nfs://server:/export", True)
+        a1.start()
+        a2.start()
+        self.assertEqual(a1.location, a2.location)
+        self.assertEqual(mount_mock.call_count, 1)
+        a1.finish()
+        self.assertFalse(umount_mock.called)
+        a2.finish()
+        self.assertEqual(umount_mock.call_count, 1)
@@ -0,0 +1,43 @@
+import threading
+import time
+import unittest
+
+from xcp import parallel
+
+class TestParallel(unittest.TestCase):
+    def test_completion_order(self):
+        def sleep(delay):
+            time.sleep(delay)
+            return delay
+        done = [result for _, result, _ in
+                parallel.iterCompleted(sleep, [0.3, 0.0, 0.1], 3)]
+        self.assertEqual(done, [0.0, 0.1, 0.3])
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        def job(_):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+        list(parallel.iterCompleted(job, range(10), 3))
+        self.assertLessEqual(state['peak'], 3)
+
+    def test_errors(self):
+        def job(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+        results = dict((item, exc_info) for item, _, exc_info in
+                       parallel.iterCompleted(job, range(4), 2))
+        self.assertIs(results[2][0], ValueError)
+        self.assertIsNone(results[1])
+
+    def test_map_ordered(self):
+        self.assertEqual(parallel.mapOrdered(lambda x: x * 2, [3, 1, 3], 4),
+                         [6, 2, 6])
+        with self.assertRaises(ValueError):
+            parallel.mapOrdered(int, ['1', 'x'], 2)
@@ -1,8 +1,11 @@
+import os
+import shutil
 import subprocess
+import tempfile
 import unittest
 from mock import patch, Mock
 
-from xcp.pci import PCI, PCIIds, PCIDevices
+from xcp.pci import PCI, PCIIds, PCIIdsIndex, PCIDevices, PCITopology
 
 class TestInvalid(unittest.TestCase):
 
@@ -79,7 +82,7 @@ class TestPCIIds(unittest.TestCase):
         with patch("xcp.pci.subprocess.Popen") as popen_mock, \
              open("tests/data/lspci-mn") as fake_data:
             popen_mock.return_value.stdout.__iter__ = Mock(return_value=iter(fake_data))
-            devs = PCIDevices()
+            devs = PCIDevices(sysfs_root=None)
         popen_mock.assert_called_once_with(['lspci', '-mn'], bufsize = 1,
                                            stdout = subprocess.PIPE)
         sorted_devices = sorted(devs.findByClass(video_class),
@@ -102,3 +105,302 @@ class TestPCIIds(unittest.TestCase):
             self.assertEqual(ids.findDevice(video_dev['vendor'], video_dev['device']), device)
 
         self.assertEqual(len(devs.findRelatedFunctions('00:18.1')), 7)
+
+
+EXTRA_IDS = """
+8086  Intel Corporation
+	1521  I350 Gigabit Network Connection
+		8086 0001  Ethernet Server Adapter I350-T4
+		1002 174b  Duplicate subsystem, first one wins
+	1521  Duplicate device
+1002  Duplicate vendor
+C 02  Network controller
+	00  Ethernet controller
+C 03  Duplicate class
+"""
+
+class TestPCIIdsIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testpci")
+        self.source = os.path.join(self.tmpdir, "pci.ids")
+        self.index = os.path.join(self.tmpdir, "pci.ids.idx")
+        with open("tests/data/pci.ids") as f:
+            contents = f.read()
+        with open(self.source, "w") as f:
+            f.write(contents + EXTRA_IDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameAnswers(self, ids, index):
+        for vendor in ids.vendor_dict.keys() + ["0000", "zzzz"]:
+            self.assertEqual(index.findVendor(vendor), ids.findVendor(vendor))
+        for key in ids.main_dict.keys() + ["1002:0000"]:
+            self.assertEqual(index.findDevice(*key.split(":")), ids.findDevice(*key.split(":")))
+        for key in ids.sub_dict.keys() + ["174b:0000"]:
+            self.assertEqual(index.findSubdevice(*key.split(":")),
+                             ids.findSubdevice(*key.split(":")))
+        self.assertEqual(index.class_dict, ids.class_dict)
+        self.assertEqual(index.lookupClass("Display"), ids.lookupClass("Display"))
+
+    def test_lookups(self):
+        ids = PCIIds(self.source)
+        index = PCIIdsIndex(self.source, self.index)
+        self.assertTrue(os.path.exists(self.index))
+        self.assertSameAnswers(ids, index)
+        self.assertEqual(index.findVendor("1002"), "Advanced Micro Devices, Inc. [AMD/ATI]")
+        self.assertEqual(index.findDevice("8086", "1521"), "I350 Gigabit Network Connection")
+        self.assertEqual(index.findSubdevice("1002", "174b"), "Duplicate subsystem, first one wins")
+
+    def test_reuse(self):
+        PCIIdsIndex(self.source, self.index)
+        with patch.object(PCIIdsIndex, "_compile") as compile_mock:
+            index = PCIIdsIndex(self.source, self.index)
+            self.assertEqual(index.findDevice("1002", "1636"), "Renoir")
+        self.assertFalse(compile_mock.called)
+
+    def test_invalidated(self):
+        PCIIdsIndex(self.source, self.index)
+        with open(self.source, "a") as f:
+            f.write("abcd  New vendor\n")
+        index = PCIIdsIndex(self.source, self.index)
+        self.assertEqual(index.findVendor("abcd"), "New vendor")
+        self.assertSameAnswers(PCIIds(self.source), PCIIdsIndex(self.source, self.index))
+
+    def test_shared(self):
+        PCIIdsIndex(self.source, self.index)
+        self.assertEqual(os.stat(self.index).st_mode & 0777, 0644)
+
+    def test_truncated(self):
+        PCIIdsIndex(self.source, self.index)
+        with open(self.index, "r+b") as f:
+            f.truncate(os.path.getsize(self.index) - 100)
+        self.assertSameAnswers(PCIIds(self.source), PCIIdsIndex(self.source, self.index))
+
+    def test_unwritable(self):
+        index = PCIIdsIndex(self.source, os.path.join(self.tmpdir, "missing", "idx"))
+        self.assertSameAnswers(PCIIds(self.source), index)
+
+    def test_read(self):
+        with patch("xcp.pci.os.path.exists") as exists_mock, \
+             patch("xcp.pci.PCIIdsIndex") as index_mock:
+            exists_mock.return_value = True
+            ids = PCIIds.read(index=self.index)
+        index_mock.assert_called_once_with("/usr/share/hwdata/pci.ids", self.index)
+        self.assertIs(ids, index_mock.return_value)
+
+class TestLookupClass(unittest.TestCase):
+    CLASSES = """
+C 01  Mass storage controller
+\t06  SATA controller
+C 02  Network controller
+C 0c  Serial bus controller
+\t03  USB controller
+C 12  Processing accelerators
+C 13  Non-Essential Instrumentation [1:x]
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testpci")
+        self.source = os.path.join(self.tmpdir, "pci.ids")
+        with open("tests/data/pci.ids") as f:
+            contents = f.read()
+        with open(self.source, "w") as f:
+            f.write(contents + self.CLASSES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def scan(ids, cls_str):
+        return [k for k, (c, sc) in ids.class_dict.items()
+                if not sc and cls_str in c]
+
+    def test_same_results(self):
+        for ids in (PCIIds(self.source),
+                    PCIIdsIndex(self.source, os.path.join(self.tmpdir, "idx"))):
+            names = [c for c, sc in ids.class_dict.values() if not sc]
+            queries = set(["", " ", "controller", "Controller", "x]", "zzz"])
+            for name in names:
+                for i in range(len(name)):
+                    for j in range(i + 1, len(name) + 1):
+                        queries.add(name[i:j])
+            for query in queries:
+                self.assertEqual(ids.lookupClass(query), self.scan(ids, query), query)
+
+    def test_words(self):
+        ids = PCIIds(self.source)
+        self.assertEqual(sorted(ids.lookupClassWords("controller")),
+                         ["01", "02", "03", "0c"])
+        self.assertEqual(ids.lookupClassWords("bus serial"), ["0c"])
+        self.assertEqual(ids.lookupClassWords("NET"), [])
+        self.assertEqual(ids.lookupClassWords("NET", prefix=True), ["02"])
+        self.assertEqual(ids.lookupClassWords("non-essential instr", prefix=True), ["13"])
+        self.assertEqual(ids.lookupClassWords(""), [])
+
+
+def make_sysfs(root, lspci_lines, domain="0000"):
+    """ Build a fake sysfs PCI devices tree from lspci -mn lines. """
+    devices = os.path.join(root, "sys", "bus", "pci", "devices")
+    os.makedirs(devices)
+    for line in lspci_lines:
+        el = [x for x in line.replace('"', '').split() if not x.startswith('-')]
+        path = os.path.join(devices, "%s:%s" % (domain, el[0]))
+        os.mkdir(path)
+        subsys = el[4:6] if len(el) == 6 else ["0000", "0000"]
+        for name, value in (("class", el[1] + "00"), ("vendor", el[2]),
+                            ("device", el[3]), ("subsystem_vendor", subsys[0]),
+                            ("subsystem_device", subsys[1])):
+            with open(os.path.join(path, name), "w") as f:
+                f.write("0x%s\n" % value)
+    return devices
+
+class TestPCIDevicesSysfs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testpci")
+        with open("tests/data/lspci-mn") as f:
+            self.lines = f.readlines()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def lspci_devices(self):
+        with patch("xcp.pci.subprocess.Popen") as popen_mock:
+            popen_mock.return_value.stdout.__iter__ = Mock(return_value=iter(self.lines))
+            return PCIDevices(sysfs_root=None)
+
+    def test_same_as_lspci(self):
+        make_sysfs(self.tmpdir, self.lines)
+        with patch("xcp.pci.subprocess.Popen") as popen_mock:
+            devs = PCIDevices(sysfs_root=self.tmpdir)
+        self.assertFalse(popen_mock.called)
+        self.assertEqual(devs.devs, self.lspci_devices().devs)
+        self.assertEqual(devs.devs["00:01.0"],
+                         {'id': "00:01.0", 'class': "06", 'subclass': "00",
+                          'vendor': "1022", 'device': "1632"})
+
+    def test_domains(self):
+        make_sysfs(self.tmpdir, self.lines[:1], domain="0001")
+        devs = PCIDevices(sysfs_root=self.tmpdir)
+        self.assertEqual(devs.devs.keys(), ["0001:00:00.0"])
+
+    def test_fallback(self):
+        devs = self.lspci_devices()
+        with patch("xcp.pci.subprocess.Popen") as popen_mock:
+            popen_mock.return_value.stdout.__iter__ = Mock(return_value=iter(self.lines))
+            fallback = PCIDevices(sysfs_root=self.tmpdir)
+        popen_mock.assert_called_once_with(['lspci', '-mn'], bufsize = 1,
+                                           stdout = subprocess.PIPE)
+        self.assertEqual(fallback.devs, devs.devs)
+
+class TestPCIDevicesQueries(unittest.TestCase):
+    def setUp(self):
+        with patch("xcp.pci.subprocess.Popen") as popen_mock, \
+             open("tests/data/lspci-mn") as fake_data:
+            popen_mock.return_value.stdout.__iter__ = Mock(return_value=iter(fake_data))
+            self.devs = PCIDevices(sysfs_root=None)
+        self.all = self.devs.devs.values()
+
+    def test_by_class(self):
+        classes = set(d['class'] for d in self.all)
+        for cls in classes:
+            self.assertEqual(self.devs.findByClass([cls]),
+                             [d for d in self.all if d['class'] == cls])
+            for subcls in set(d['subclass'] for d in self.all if d['class'] == cls):
+                self.assertEqual(self.devs.findByClass(cls, subcls),
+                                 [d for d in self.all if d['class'] == cls and
+                                  d['subclass'] == subcls])
+        self.assertEqual(self.devs.findByClass(sorted(classes)), self.all)
+        self.assertEqual(self.devs.findByClass(['ff']), [])
+
+    def test_by_vendor(self):
+        self.assertEqual(self.devs.findByVendor('1002'),
+                         [d for d in self.all if d['vendor'] == '1002'])
+        self.assertEqual([d['id'] for d in self.devs.findByVendor('1002', '1636')],
+                         ['07:00.0'])
+
+    def test_functions(self):
+        for dev_id in self.devs.devs:
+            slot = dev_id.rsplit('.', 1)[0]
+            same_slot = [x for x in self.devs.devs if x.rsplit('.', 1)[0] == slot]
+            self.assertEqual(self.devs.findFunctions(slot), same_slot)
+            self.assertEqual(self.devs.findRelatedFunctions(dev_id),
+                             [x for x in same_slot if x != dev_id])
+        self.assertEqual(self.devs.findFunctions('ff:1f'), [])
+
+
+class TestPCITopology(unittest.TestCase):
+    # device path below sys/devices, numa_node, local_cpulist
+    TREE = [
+        ("pci0000:00/0000:00:00.0", "0", "0-3"),
+        ("pci0000:00/0000:00:01.1", "0", "0-3"),
+        ("pci0000:00/0000:00:01.1/0000:01:00.0", "0", "0-3"),
+        ("pci0000:00/0000:00:01.1/0000:01:00.0/0000:02:00.0", "0", "0-3"),
+        ("pci0000:00/0000:00:01.1/0000:01:00.0/0000:02:00.1", "0", "0-3"),
+        ("pci0000:00/0000:00:01.1/0000:01:00.0/0000:02:10.0", "0", "0-3"),
+        ("pci0001:80/0001:80:02.0", "1", "4-5,8"),
+        ("pci0001:80/0001:80:02.0/0001:81:00.0", "1", "4-5,8"),
+        ("pci0001:80/0001:80:03.0", "-1", ""),
+        ("pci000e:00/000e:00:01.0", "-1", ""),
+        ("pci000e:00/000e:00:01.0/000e:01:00.0", "-1", ""),
+        # NVMe behind a VMD controller, in a 5 digit domain
+        ("pci0000:00/0000:00:0e.0", "0", "0-3"),
+        ("pci0000:00/0000:00:0e.0/pci10000:00/10000:00:01.0", "0", "0-3"),
+        ("pci0000:00/0000:00:0e.0/pci10000:00/10000:00:01.0/10000:01:00.0", "0", "0-3"),
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testpci")
+        sysfs = os.path.join(self.tmpdir, "sys")
+        devices = os.path.join(sysfs, "bus", "pci", "devices")
+        os.makedirs(devices)
+        for path, node, cpus in self.TREE:
+            full = os.path.join(sysfs, "devices", path)
+            os.makedirs(full)
+            for name, value in (("numa_node", node), ("local_cpulist", cpus)):
+                with open(os.path.join(full, name), "w") as f:
+                    f.write(value + "\n")
+            os.symlink(os.path.join("..", "..", "..", "devices", path),
+                       os.path.join(devices, os.path.basename(path)))
+        pf = os.path.join(sysfs, "devices", self.TREE[3][0])
+        with open(os.path.join(pf, "sriov_numvfs"), "w") as f:
+            f.write("1\n")
+        os.symlink(os.path.join("..", "0000:02:00.0"),
+                   os.path.join(sysfs, "devices", self.TREE[5][0], "physfn"))
+        self.topo = PCITopology(sysfs_root=self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hierarchy(self):
+        topo = self.topo
+        self.assertEqual(len(topo.devices()), len(self.TREE))
+        self.assertEqual(topo.ancestorsOf("02:00.1"), ["0000:01:00.0", "0000:00:01.1"])
+        self.assertEqual(topo.ancestorsOf("0000:00:00.0"), [])
+        self.assertEqual(topo.descendantsOf("00:01.1"),
+                         set(["0000:01:00.0", "0000:02:00.0", "0000:02:00.1",
+                              "0000:02:10.0"]))
+        self.assertEqual(topo.descendantsOf("02:00.0"), set())
+        self.assertTrue(topo.isAncestor("00:01.1", "0000:02:10.0"))
+        self.assertFalse(topo.isAncestor("02:00.0", "02:00.1"))
+        self.assertEqual(topo.rootPort("02:00.0"), "0000:00:01.1")
+        self.assertEqual(topo.rootPort("0001:81:00.0"), "0001:80:02.0")
+        self.assertEqual(topo.rootPort("00:00.0"), "0000:00:00.0")
+        self.assertEqual(topo.ancestorsOf("000e:01:00.0"), ["000e:00:01.0"])
+        self.assertEqual(topo.ancestorsOf("10000:01:00.0"), ["10000:00:01.0"])
+        self.assertEqual(topo.rootPort("10000:01:00.0"), "10000:00:01.0")
+
+    def test_numa(self):
+        topo = self.topo
+        self.assertEqual(topo.numaNode("02:00.0"), 0)
+        self.assertEqual(topo.numaNode("0001:80:03.0"), None)
+        self.assertTrue(topo.sameNuma("00:00.0", "02:10.0"))
+        self.assertFalse(topo.sameNuma("00:00.0", "0001:81:00.0"))
+        self.assertFalse(topo.sameNuma("0001:80:03.0", "0001:80:03.0"))
+        self.assertEqual(topo.onNode(1), set(["0001:80:02.0", "0001:81:00.0"]))
+        self.assertEqual(topo.localCpus("0001:81:00.0"), set([4, 5, 8]))
+        self.assertEqual(topo.localCpus("0001:80:03.0"), set())
+
+    def test_sriov(self):
+        self.assertEqual(self.topo.sriov_numvfs, {"0000:02:00.0": 1})
+        self.assertEqual(self.topo.physfn, {"0000:02:10.0": "0000:02:00.0"})
@@ -1,9 +1,19 @@
+import hashlib
+import marshal
+import md5
+import os
+import shutil
+import StringIO
+import tempfile
 import unittest
+from mock import patch
 
 import xcp.accessor
 from xcp import repository
 from xcp.version import Version
 
+from standin_servers import Faults, FTPStandIn, HTTPStandIn
+
 class TestRepository(unittest.TestCase):
     def test_http(self):
         raise unittest.SkipTest("comment out if you really mean it")
@@ -23,3 +33,595 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(product_ver, Version([8, 2, 1]))
         repos = repository.BaseRepository.findRepositories(a)
         self.assertEqual(len(repos), 1)
+
+class TestPackageVerify(unittest.TestCase):
+    def setUp(self):
+        self.a = xcp.accessor.createAccessor("file://tests/data/xsrepo/", True)
+        self.a.start()
+        self.repo = repository.Repository(self.a, "")
+        self.pkgs = dict((p.label, p) for p in self.repo.packages)
+
+    def tearDown(self):
+        self.a.finish()
+
+    def test_verify(self):
+        for threaded in (False, True):
+            for label in ('foo', 'bar', 'fw'):
+                pkg = self.pkgs[label]
+                with pkg.open(threaded) as f:
+                    data = ''
+                    while True:
+                        chunk = f.read(100)
+                        if not chunk:
+                            break
+                        data += chunk
+                    self.assertTrue(f.verified)
+                self.assertEqual(len(data), pkg.size)
+
+    def test_mismatch(self):
+        for threaded in (False, True):
+            with self.pkgs['broken'].open(threaded) as f:
+                with self.assertRaises(repository.VerifyError) as first:
+                    f.read()
+                # later reads do not look like a clean end of file
+                for size in (-1, 100):
+                    with self.assertRaises(repository.VerifyError) as again:
+                        f.read(size)
+                    self.assertIs(again.exception, first.exception)
+                self.assertTrue(f.checked)
+                self.assertFalse(f.verified)
+
+    def test_size_mismatch(self):
+        pkg = self.pkgs['foo']
+        f = repository.VerifyingFile(StringIO.StringIO("foo"), pkg.filename,
+                                     pkg.size, pkg.md5sum)
+        self.assertEqual(f.read(0), "")
+        self.assertEqual(f.read(2), "fo")
+        with self.assertRaisesRegexp(repository.VerifyError, "size 3"):
+            f.read(10)
+            f.read(10)
+
+class TestFindMany(unittest.TestCase):
+    def setUp(self):
+        self.servers = [HTTPStandIn(root).start()
+                        for root in ("tests/data/repo", "tests/data/xsrepo")]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_find_many(self):
+        accessors = [xcp.accessor.createAccessor(server.url, True)
+                     for server in self.servers]
+        accessors.append(xcp.accessor.createAccessor("file://tests/data/xsrepo/", True))
+        results = {}
+        for access, repos, exc_info in \
+                repository.BaseRepository.findRepositoriesMany(accessors, workers=2):
+            self.assertIsNone(exc_info)
+            results[access] = repos
+
+        self.assertEqual(len(results), 3)
+        yum_repos = results[accessors[0]]
+        self.assertEqual(len(yum_repos), 1)
+        self.assertIsInstance(yum_repos[0], repository.YumRepository)
+        for access in accessors[1:]:
+            self.assertEqual([r.identifier for r in results[access]], ["xcp:main"])
+            self.assertEqual(len(results[access][0].packages), 4)
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        self.root = os.path.join(self.tmpdir, "repo")
+        shutil.copytree("tests/data/xsrepo", self.root)
+        self.cache = repository.MetadataCache(os.path.join(self.tmpdir, "cache"))
+        self.a = xcp.accessor.createAccessor("file://%s/" % self.root, True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def describe(repo):
+        return (repo.identifier, str(repo.product_version), repo.description,
+                repo.requires, repo._md5.hexdigest(),
+                [(p.__class__, p.repository is repo,
+                  [getattr(p, f, None) for f in ('label', 'size', 'md5sum',
+                                                 'optional', 'filename',
+                                                 'destination', 'options',
+                                                 'kernel')])
+                 for p in repo.packages])
+
+    def test_cached(self):
+        uncached = repository.Repository(self.a, "")
+        first = repository.Repository(self.a, "", cache=self.cache)
+        self.assertEqual(len(os.listdir(self.cache.directory)), 1)
+        with patch.object(repository.Repository, "_parse_packages") as parse_mock:
+            second = repository.Repository(self.a, "", cache=self.cache)
+        self.assertFalse(parse_mock.called)
+        self.assertEqual(self.describe(uncached), self.describe(first))
+        self.assertEqual(self.describe(uncached), self.describe(second))
+
+    def test_invalidated(self):
+        repository.Repository(self.a, "", cache=self.cache)
+        with open(os.path.join(self.root, "XS-PACKAGES")) as f:
+            contents = f.read()
+        with open(os.path.join(self.root, "XS-PACKAGES"), "w") as f:
+            f.write(contents.replace('label="fw"', 'label="firmware"'))
+        repo = repository.Repository(self.a, "", cache=self.cache)
+        self.assertIn("firmware", [p.label for p in repo.packages])
+        self.assertEqual(len(os.listdir(self.cache.directory)), 2)
+
+    def test_prune(self):
+        record = {'packages': [('rpm', ('x' * 1000,))]}
+        size = len(marshal.dumps((self.cache.FORMAT, record)))
+        self.cache.max_bytes = 3 * size
+        for i in range(3):
+            self.cache.store("source", str(i), record)
+            # oldest first
+            os.utime(self.cache._path("source", str(i)), (i, i))
+        self.assertEqual(self.cache.load("source", "0"), record)
+        self.cache.store("source", "3", record)
+        self.assertEqual(len(os.listdir(self.cache.directory)), 3)
+        self.assertIsNone(self.cache.load("source", "1"))
+        for i in (0, 2, 3):
+            self.assertEqual(self.cache.load("source", str(i)), record)
+
+class TestFindRepositories(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        for loc in ("", "packages.main", "extra2", "extra1"):
+            if loc:
+                os.mkdir(os.path.join(self.tmpdir, loc))
+            for fn in ("XS-REPOSITORY", "XS-PACKAGES"):
+                shutil.copy(os.path.join("tests/data/xsrepo", fn),
+                            os.path.join(self.tmpdir, loc, fn))
+        with open(os.path.join(self.tmpdir, "XS-REPOSITORY-LIST"), "w") as f:
+            f.write("extra2\nmissing\nextra1\n")
+        self.server = HTTPStandIn(self.tmpdir, Faults(latency=0.01)).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_order(self):
+        a = xcp.accessor.createAccessor(self.server.url, True)
+        repos = repository.Repository.findRepositories(a)
+        self.assertEqual([r.base for r in repos],
+                         ["", "packages.main", "extra2", "extra1"])
+        self.assertEqual(a.stats.snapshot()['opens'], 1 + 4 * 2 + 4 * 2)
+
+class TestParsePackages(unittest.TestCase):
+    def parse(self, contents):
+        repo = repository.Repository.__new__(repository.Repository)
+        repo.packages = []
+        repo._md5 = md5.new()
+        repo._parse_packages(StringIO.StringIO(contents))
+        self.assertEqual(repo._md5.hexdigest(), md5.new(contents).hexdigest())
+        return repo.packages
+
+    def test_streaming(self):
+        entry = ('<package type="rpm" label="p%d" size="%d" md5="%032x">\n'
+                 '  <!-- comment -->pkgs/p%d.rpm  </package>\n')
+        contents = "<packages>\n%s</packages>\n" % ''.join(
+            entry % (i, i, i, i) for i in range(3000))
+        self.assertGreater(len(contents), 2 * repository.Repository.PARSE_BUFSIZE)
+        packages = self.parse(contents)
+        self.assertEqual(len(packages), 3000)
+        self.assertEqual((packages[1234].label, packages[1234].size,
+                          packages[1234].filename, packages[1234].options),
+                         ("p1234", 1234, "pkgs/p1234.rpm", ""))
+
+    def test_errors(self):
+        for contents in ("", "<packages>",
+                         '<packages><package type="rpm" label="x" size="1">f</package></packages>',
+                         '<packages><package type="deb" label="x" size="1" md5="0">f</package></packages>',
+                         '<packages><package type="rpm" label="x" size="y" md5="0">f</package></packages>',
+                         '<packages><package type="rpm" label="x" size="1" md5="0">f</package></packages>',
+                         '<packages><package type="rpm" label="x" size="1" md5="%s">f</package></packages>' % ("z" * 32)):
+            with self.assertRaises(repository.RepoFormatError):
+                self.parse(contents)
+
+    def test_compact(self):
+        md5sum = "%032X" % 0xabc
+        entry = ('<package type="driver-rpm" label="d%d" size="10" md5="%s" '
+                 'kernel="4.19.0+1" options="-i">d%d.rpm</package>')
+        packages = self.parse("<packages>%s</packages>" % ''.join(
+            entry % (i, md5sum, i) for i in range(2)))
+        for pkg in packages:
+            self.assertFalse(hasattr(pkg, "__dict__"))
+            self.assertEqual(pkg.md5sum, md5sum.lower())
+            self.assertEqual(pkg.size, 10)
+            self.assertIs(type(pkg.size), int)
+        self.assertIs(packages[0].kernel, packages[1].kernel)
+        self.assertIs(packages[0].options, packages[1].options)
+
+class TestYumPackages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        self.a = xcp.accessor.createAccessor("file://tests/data/yumrepo/", True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, repo):
+        self.assertEqual(len(repo.packages), 5)
+        kernels = repo.findPackages(name="kernel")
+        self.assertEqual(sorted(p.evr for p in kernels),
+                         ["4.19.19-7.0.13.1.xcpng8.2", "4.19.19-7.0.14.1.xcpng8.2"])
+        self.assertEqual([p.name for p in repo.findPackages(arch="noarch")],
+                         ["xcp-python-libs"])
+        pkg = repo.findPackages(name="xcp-ng-release", arch="x86_64")[0]
+        self.assertEqual((pkg.size, pkg.checksum_type, pkg.location),
+                         (21340, "sha256",
+                          "Packages/xcp-ng-release-8.2.1-3.x86_64.rpm"))
+        self.assertEqual(len(pkg.checksum), 64)
+        self.assertIsInstance(pkg.name, str)
+
+    def test_packages(self):
+        repos = repository.BaseRepository.findRepositories(self.a)
+        self.assertEqual(len(repos), 1)
+        self.check(repos[0])
+
+    def test_index(self):
+        repo = repository.YumRepository(self.a, index_dir=self.tmpdir)
+        self.check(repo)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        with patch.object(repository.YumRepository, "_readPrimary") as read_mock:
+            self.check(repository.YumRepository(self.a, index_dir=self.tmpdir))
+        self.assertFalse(read_mock.called)
+
+    def test_checksum_mismatch(self):
+        root = os.path.join(self.tmpdir, "repo")
+        shutil.copytree("tests/data/yumrepo", root)
+        repomd = os.path.join(root, "repodata", "repomd.xml")
+        with open(repomd) as f:
+            contents = f.read()
+        with open(repomd, "w") as f:
+            f.write(contents.replace('<checksum type="sha256">6',
+                                     '<checksum type="sha256">7'))
+        a = xcp.accessor.createAccessor("file://%s/" % root, True)
+        with self.assertRaises(repository.RepoFormatError):
+            repository.YumRepository(a).packages
+
+class TestRepositoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        self.repos = [self.make_repo("main", "tests/data/xsrepo")]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_repo(self, name, source, repofile=None):
+        root = os.path.join(self.tmpdir, name)
+        shutil.copytree(source, root)
+        if repofile:
+            with open(os.path.join(root, "XS-REPOSITORY"), "w") as f:
+                f.write(repofile)
+        a = xcp.accessor.createAccessor("file://%s/" % root, True)
+        return repository.Repository(a, "")
+
+    def base_repo(self, version):
+        return self.make_repo(
+            "base-" + version, "tests/data/xsrepo",
+            '<repository originator="xcp" name="base" product="XCP-ng" version="%s">'
+            '<description>Base</description></repository>' % version)
+
+    def test_lookup(self):
+        index = repository.RepositoryIndex(self.repos + [self.base_repo("8.2.0")])
+        self.assertEqual([p.label for p in index.findPackages(label="foo")],
+                         ["foo", "foo"])
+        self.assertEqual([p.label for p in index.findPackages(ptype="rpm")],
+                         ["foo", "broken", "foo", "broken"])
+        bar = index.findPackages(kernel="4.19.0+1", ptype="driver-rpm", label="bar")
+        self.assertEqual([p.repository for p in bar], [r for r in index.repos])
+        self.assertEqual(index.findPackages(kernel="4.19.0+1", ptype="rpm"), [])
+        self.assertEqual(len(index.findPackages()), 8)
+
+    def test_requires(self):
+        index = repository.RepositoryIndex(self.repos)
+        self.assertEqual([req['name'] for _, req in index.unsatisfied()], ["base"])
+        index = repository.RepositoryIndex(self.repos + [self.base_repo("8.1")])
+        self.assertEqual(len(index.unsatisfied()), 1)
+        index = repository.RepositoryIndex(self.repos + [self.base_repo("8.2.0")])
+        self.assertEqual(index.unsatisfied(), [])
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp(prefix="testfetch")
+        a = xcp.accessor.createAccessor("file://tests/data/xsrepo/", True)
+        self.repo = repository.Repository(a, "")
+        self.progress = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def report(self, pkg, status, done, total):
+        self.progress.append((pkg.label, status, done, total))
+
+    def test_fetch(self):
+        failed = self.repo.fetch(self.dest, workers=4, progress=self.report)
+        self.assertEqual([p.label for p in failed], ["broken"])
+        self.assertEqual(sorted(p[:2] for p in self.progress),
+                         [("bar", "fetched"), ("broken", "failed"),
+                          ("foo", "fetched"), ("fw", "fetched")])
+        self.assertEqual([p[2:] for p in self.progress],
+                         [(i, 4) for i in range(1, 5)])
+        for pkg in self.repo.packages:
+            path = os.path.join(self.dest, pkg.filename)
+            if pkg in failed:
+                self.assertFalse(os.path.exists(path))
+                self.assertFalse(os.path.exists(path + ".part"))
+            else:
+                with open(path, "rb") as f:
+                    self.assertEqual(hashlib.md5(f.read()).hexdigest(), pkg.md5sum)
+
+    def test_skip_existing(self):
+        good = [p for p in self.repo.packages if p.label != "broken"]
+        self.assertEqual(self.repo.fetch(self.dest, good), [])
+        stale = os.path.join(self.dest, good[0].filename)
+        with open(stale, "wb") as f:
+            f.write("x" * good[0].size)
+        self.assertEqual(self.repo.fetch(self.dest, good, progress=self.report), [])
+        self.assertEqual(sorted(p[:2] for p in self.progress),
+                         sorted((p.label, "fetched" if p is good[0] else "skipped")
+                                for p in good))
+
+    def test_unsafe_filename(self):
+        pkg = self.repo.packages[0]
+        for fname in ("../escape.bin", "packages/../../escape.bin",
+                      os.path.join(self.dest, "abs.bin")):
+            pkg.filename = fname
+            with self.assertRaises(repository.RepoFormatError):
+                self.repo._fetchPackage(pkg, os.path.join(self.dest, "sub"))
+            self.assertEqual(self.repo.fetch(os.path.join(self.dest, "sub"), [pkg]), [pkg])
+        self.assertEqual(os.listdir(self.dest), [])
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testsync")
+        self.src = os.path.join(self.tmpdir, "src")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        shutil.copytree("tests/data/xsrepo", self.src)
+        os.mkdir(self.dest)
+        self.dest_access = xcp.accessor.createAccessor("file://%s/" % self.dest, False)
+        self.progress = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def report(self, pkg, status, done, total):
+        self.progress.append((pkg.label, status))
+
+    def source(self):
+        a = xcp.accessor.createAccessor("file://%s/" % self.src, True)
+        return repository.Repository(a, "")
+
+    def edit_packages(self, old, new):
+        path = os.path.join(self.src, "XS-PACKAGES")
+        with open(path) as f:
+            contents = f.read()
+        with open(path, "w") as f:
+            f.write(contents.replace(old, new))
+
+    def snapshot(self):
+        files = {}
+        for root, _, names in os.walk(self.dest):
+            for name in names:
+                with open(os.path.join(root, name), "rb") as f:
+                    files[os.path.relpath(os.path.join(root, name), self.dest)] = f.read()
+        return files
+
+    def remove_broken(self):
+        self.edit_packages('<package type="rpm" label="broken"', '<!-- ')
+        self.edit_packages('broken.rpm</package>', ' -->')
+
+    def test_read_only(self):
+        dest = xcp.accessor.createAccessor("file://%s/" % self.dest, True)
+        with self.assertRaises(ValueError):
+            self.source().sync(dest)
+        self.assertEqual(self.snapshot(), {})
+
+    def test_unsafe_filename(self):
+        self.edit_packages(">packages/fw.bin<", ">packages/../../fw.bin<")
+        with self.assertRaises(repository.RepoFormatError):
+            self.source().sync(self.dest_access)
+        self.assertEqual(self.snapshot(), {})
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["dest", "src"])
+
+    def test_failure(self):
+        failed = self.source().sync(self.dest_access)
+        self.assertEqual([p.label for p in failed], ["broken"])
+        self.assertEqual(os.listdir(self.dest), [])
+        self.assertFalse(repository.Repository.isRepo(self.dest_access, ""))
+
+    def test_failure_keeps_published(self):
+        with open(os.path.join(self.src, "XS-PACKAGES")) as f:
+            packages = f.read()
+        self.remove_broken()
+        self.assertEqual(self.source().sync(self.dest_access), [])
+        published = self.snapshot()
+
+        # a changed package, and a broken one
+        with open(os.path.join(self.src, "XS-PACKAGES"), "w") as f:
+            f.write(packages)
+        with open(os.path.join(self.src, "packages", "fw.bin"), "wb") as f:
+            f.write("new firmware")
+        self.edit_packages('size="1024" md5="b2ea9f7fcea831a4a63b213f41a8855b"',
+                           'size="12" md5="%s"' % hashlib.md5("new firmware").hexdigest())
+        failed = self.source().sync(self.dest_access)
+        self.assertEqual([p.label for p in failed], ["broken"])
+        self.assertEqual(self.snapshot(), published)
+        self.assertNotIn(".xs-sync", os.listdir(self.dest))
+        dest_repo = repository.Repository(self.dest_access, "")
+        for pkg in dest_repo.packages:
+            self.dest_access.start()
+            with pkg.open() as f:
+                f.read()
+            self.dest_access.finish()
+
+    def test_incremental(self):
+        self.remove_broken()
+        self.assertEqual(self.source().sync(self.dest_access, progress=self.report), [])
+        self.assertEqual(sorted(self.progress),
+                         [("bar", "fetched"), ("foo", "fetched"), ("fw", "fetched")])
+        for name in ("XS-REPOSITORY", "XS-PACKAGES", "packages/fw.bin"):
+            with open(os.path.join(self.dest, name)) as f:
+                with open(os.path.join(self.src, name)) as g:
+                    self.assertEqual(f.read(), g.read())
+        self.assertNotIn(".xs-sync", os.listdir(self.dest))
+
+        # nothing to do
+        self.progress = []
+        self.assertEqual(self.source().sync(self.dest_access, progress=self.report), [])
+        self.assertEqual(self.progress, [])
+
+        # only the changed package is transferred
+        fw = os.path.join(self.src, "packages", "fw.bin")
+        with open(fw, "wb") as f:
+            f.write("new firmware")
+        self.edit_packages('size="1024" md5="b2ea9f7fcea831a4a63b213f41a8855b"',
+                           'size="12" md5="%s"' % hashlib.md5("new firmware").hexdigest())
+        self.assertEqual(self.source().sync(self.dest_access, progress=self.report), [])
+        self.assertEqual(sorted(self.progress),
+                         [("bar", "skipped"), ("foo", "skipped"), ("fw", "fetched")])
+        with open(os.path.join(self.dest, "packages", "fw.bin")) as f:
+            self.assertEqual(f.read(), "new firmware")
+        dest_repo = repository.Repository(self.dest_access, "")
+        self.assertEqual(dest_repo._md5.hexdigest(), self.source()._md5.hexdigest())
+
+    def test_ftp(self):
+        server = FTPStandIn(self.dest).start()
+        try:
+            dest = xcp.accessor.createAccessor(server.url, False)
+            failed = self.source().sync(dest)
+            self.assertEqual([p.label for p in failed], ["broken"])
+            self.assertEqual(os.listdir(self.dest), [])
+
+            self.remove_broken()
+            self.assertEqual(self.source().sync(dest), [])
+            with open(os.path.join(self.src, "packages", "fw.bin"), "wb") as f:
+                f.write("new firmware")
+            self.edit_packages('size="1024" md5="b2ea9f7fcea831a4a63b213f41a8855b"',
+                               'size="12" md5="%s"' % hashlib.md5("new firmware").hexdigest())
+            self.assertEqual(self.source().sync(dest, progress=self.report), [])
+        finally:
+            server.stop()
+        self.assertEqual(sorted(self.progress),
+                         [("bar", "skipped"), ("foo", "skipped"), ("fw", "fetched")])
+        for name in ("XS-REPOSITORY", "XS-PACKAGES", "packages/fw.bin"):
+            with open(os.path.join(self.dest, name)) as f:
+                with open(os.path.join(self.src, name)) as g:
+                    self.assertEqual(f.read(), g.read())
+        self.assertNotIn(".xs-sync", os.listdir(self.dest))
+
+class TestLazy(unittest.TestCase):
+    def setUp(self):
+        self.a = xcp.accessor.createAccessor("file://tests/data/xsrepo/", True)
+
+    def test_lazy(self):
+        eager = repository.Repository(self.a, "")
+        with patch.object(repository.Repository, "_parse_packages",
+                          autospec=True,
+                          side_effect=repository.Repository._parse_packages) as parse_mock:
+            repo = repository.Repository(self.a, "", lazy=True)
+            self.assertEqual(repo.identifier, "xcp:main")
+            self.assertFalse(parse_mock.called)
+            self.assertEqual([p.label for p in repo.packages],
+                             [p.label for p in eager.packages])
+            repo.packages
+            self.assertEqual(parse_mock.call_count, 1)
+        self.assertEqual(repo._md5.hexdigest(), eager._md5.hexdigest())
+
+    def test_no_partial_packages(self):
+        repo = repository.Repository(self.a, "", lazy=True)
+        repo_md5 = repo._md5.hexdigest()
+        create = repository.Repository._create_package
+        seen = []
+        def create_package(self, *args):
+            seen.append((self._packages, self._md5.hexdigest()))
+            return create(self, *args)
+        with patch.object(repository.Repository, "_create_package", create_package):
+            self.assertEqual(len(repo.packages), 4)
+        self.assertEqual(seen, [(None, repo_md5)] * 4)
+        self.assertNotEqual(repo._md5.hexdigest(), repo_md5)
+
+    def test_lazy_cached(self):
+        tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        try:
+            cache = repository.MetadataCache(tmpdir)
+            first = repository.Repository(self.a, "", cache=cache, lazy=True)
+            self.assertEqual(os.listdir(tmpdir), [])
+            self.assertEqual(len(first.packages), 4)
+            with patch.object(repository.Repository, "_parse_packages") as parse_mock:
+                second = repository.Repository(self.a, "", cache=cache, lazy=True)
+                self.assertEqual([p.label for p in second.packages],
+                                 [p.label for p in first.packages])
+            self.assertFalse(parse_mock.called)
+            self.assertEqual(second._md5.hexdigest(), first._md5.hexdigest())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_missing_packages(self):
+        tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        try:
+            shutil.copy("tests/data/xsrepo/XS-REPOSITORY", tmpdir)
+            a = xcp.accessor.createAccessor("file://%s/" % tmpdir, True)
+            repo = repository.Repository(a, "", lazy=True)
+            for _ in range(2):
+                with self.assertRaises(repository.NoRepository):
+                    repo.packages
+            with self.assertRaises(repository.NoRepository):
+                repository.Repository(a, "")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_version_probe(self):
+        ver = repository.Repository.getRepoVer(self.a)
+        self.assertEqual(str(ver), "8.2.1-1")
+        # XS-REPOSITORY only
+        self.assertEqual(self.a.stats.snapshot()['opens'], 1)
+
+class TestYumFileCache(unittest.TestCase):
+    def test_single_fetch(self):
+        # without a session of the caller's
+        a = xcp.accessor.createAccessor("file://tests/data/yumrepo/", True)
+        repo_ver = repository.BaseRepository.getRepoVer(a)
+        self.assertEqual(a.stats.snapshot()['opens'], 2)
+        product_ver = repository.BaseRepository.getProductVersion(a)
+        self.assertEqual(a.stats.snapshot()['opens'], 4)
+        self.assertEqual(a.session_cache, {})
+
+        # within one, each file is read once
+        b = xcp.accessor.createAccessor("file://tests/data/yumrepo/", True)
+        b.start()
+        self.assertTrue(repository.YumRepository.isRepo(b, ""))
+        self.assertEqual(repository.BaseRepository.getRepoVer(b), repo_ver)
+        self.assertEqual(repository.BaseRepository.getProductVersion(b), product_ver)
+        self.assertEqual(repository.YumRepository.getRepoVer(b), repo_ver)
+        self.assertEqual(b.stats.snapshot()['opens'], 2)
+        b.finish()
+        self.assertEqual(b.session_cache, {})
+
+    def test_missing(self):
+        a = xcp.accessor.createAccessor("file://tests/data/xsrepo/", True)
+        a.start()
+        for _ in range(2):
+            self.assertFalse(repository.YumRepository.isRepo(a, ""))
+        self.assertEqual(a.stats.snapshot()['errors'], 1)
+        with self.assertRaises(repository.RepoFormatError):
+            repository.YumRepository.getRepoVer(a)
+        a.finish()
+
+    def test_session(self):
+        tmpdir = tempfile.mkdtemp(prefix="testrepo")
+        try:
+            a = xcp.accessor.createAccessor("file://%s/" % tmpdir, True)
+            a.start()
+            self.assertFalse(repository.YumRepository.isRepo(a, ""))
+            shutil.rmtree(tmpdir)
+            shutil.copytree("tests/data/yumrepo", tmpdir)
+            # missing files are remembered for the session only
+            self.assertFalse(repository.YumRepository.isRepo(a, ""))
+            a.finish()
+            self.assertTrue(repository.YumRepository.isRepo(a, ""))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,92 @@
+import unittest
+from operator import attrgetter
+
+from xcp.version import Constraint, Version, satisfying
+
+class TestVersion(unittest.TestCase):
+    def test_from_string(self):
+        v = Version.from_string("8.2.1-release")
+        self.assertEqual(v.ver, [8, 2, 1])
+        self.assertEqual(v.build, "release")
+        self.assertEqual(str(v), "8.2.1-release")
+        self.assertEqual(str(Version.from_string("1.rc2")), "1.rc2")
+
+    def test_compare(self):
+        self.assertEqual(Version([1, 2]), Version.from_string("1.2-7"))
+        self.assertTrue(Version([1, 2]) < Version([1, 2, 0]))
+        self.assertTrue(Version([1, 10]) > Version([1, 9, 9]))
+        self.assertTrue(Version([2]) >= Version([2]))
+        self.assertTrue(Version([2]) <= Version([10]))
+        self.assertTrue(Version([2]) != Version([2, 1]))
+        self.assertFalse(Version([2]) == None)
+        self.assertNotEqual(Version([2]), "2")
+        self.assertEqual(Version.ver_cmp([1, 2], [1, 3]), -1)
+
+    def test_hash_sort(self):
+        versions = [Version.from_string(s) for s in
+                    ("1.10", "1.2-a", "1.2-b", "1.9.1", "0.9")]
+        self.assertEqual(len(set(versions)), 4)
+        ordered = ["0.9", "1.2-a", "1.2-b", "1.9.1", "1.10"]
+        self.assertEqual(map(str, sorted(versions)), ordered)
+        self.assertEqual(map(str, sorted(versions, key=attrgetter('key'))), ordered)
+
+    def test_read_only(self):
+        v = Version.from_string("8.2.1-release")
+        with self.assertRaises(AttributeError):
+            v.ver = [9]
+        with self.assertRaises(AttributeError):
+            v.build = "other"
+        v.ver.append(0)
+        self.assertEqual(v, Version([8, 2, 1]))
+        self.assertEqual(hash(v), hash(Version([8, 2, 1])))
+
+    def test_cmp_hooks(self):
+        class Descending(Version):
+            __slots__ = ()
+
+            @classmethod
+            def arc_cmp(cls, l, r):
+                return r - l
+
+        versions = [Descending.from_string(s) for s in ("1.2", "1.10", "2")]
+        self.assertTrue(versions[1] < versions[0])
+        self.assertEqual(Descending([1, 2]), versions[0])
+        self.assertEqual(map(str, sorted(versions)), ["2", "1.10", "1.2"])
+        gt, = satisfying([Constraint('gt', Descending([1, 5]))], versions)
+        self.assertEqual(map(str, gt), ["1.2"])
+
+    def test_shared(self):
+        self.assertIs(Version.from_string("3.2.1-x"), Version.from_string("3.2.1-x"))
+        first = Version.from_string("0.0.1")
+        for i in range(Version.CACHE_SIZE):
+            Version.from_string("0.1.%d" % i)
+        self.assertIsNot(Version.from_string("0.0.1"), first)
+        self.assertEqual(Version.from_string("0.0.1"), first)
+
+class TestConstraint(unittest.TestCase):
+    def test_match(self):
+        ge = Constraint('ge', "8.2.0-1")
+        self.assertFalse(ge(Version.from_string("8.2")))
+        self.assertTrue(ge(Version.from_string("8.2.0-7")))
+        self.assertTrue(ge(Version.from_string("8.10")))
+        self.assertFalse(Constraint('ne', Version([1]))(Version([1])))
+        self.assertRaises(ValueError, Constraint, 'gte', "1")
+
+    def test_satisfying(self):
+        versions = [Version.from_string(s) for s in
+                    ("1.10", "1.2-a", "0.9", "1.2-b", "1.9.1")]
+        constraints = [Constraint(test, "1.2") for test in
+                       ('eq', 'ne', 'lt', 'gt', 'le', 'ge')]
+        results = satisfying(constraints, versions)
+        for constraint, result in zip(constraints, results):
+            expected = sorted((v for v in versions if constraint(v)),
+                              key=attrgetter('key'))
+            self.assertEqual([str(v) for v in result], [str(v) for v in expected])
+        self.assertEqual([str(v) for v in results[0]], ["1.2-a", "1.2-b"])
+
+    def test_key(self):
+        candidates = [("a", "2.0"), ("b", "1.0"), ("c", "3.0")]
+        result, = satisfying([Constraint('gt', "1.5")], candidates,
+                             key=lambda c: Version.from_string(c[1]))
+        self.assertEqual([c[0] for c in result], ["a", "c"])
+        self.assertEqual(satisfying([Constraint('eq', "1")], []), [[]])
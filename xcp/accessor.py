@@ -25,9 +25,15 @@
 
 """accessor - provide common interface to access methods"""
 
+import ctypes
+import ctypes.util
 import ftplib
+import hashlib
 import os
-import tempfile
+import stat
+import sys
+import threading
+import time
 import types
 import urllib
 import urllib2
@@ -36,6 +42,7 @@ import errno
 
 import xcp.mount as mount
 import xcp.logger as logger
+import xcp.parallel as parallel
 
 # maps errno codes to HTTP error codes
 # needed for error code consistency
@@ -49,11 +56,288 @@ def mapError(errorCode):
     else:
         return 500
 
+# size of the buffer used when the data has to go through userspace
+COPY_BUFSIZE = 1024 * 1024
+
+def _loadSendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno = True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_sendfile = _loadSendfile()
+
+def _fileno(fh):
+    try:
+        return fh.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+def _sendfileCopy(in_fh, out_fh):
+    """ Copy in kernel space when in_fh is a regular file and out_fh is
+    backed by a file descriptor.  Returns the number of bytes copied, or
+    None if the caller has to fall back to copying through userspace. """
+    if not _sendfile:
+        return None
+    in_fd, out_fd = _fileno(in_fh), _fileno(out_fh)
+    if in_fd is None or out_fd is None:
+        return None
+    if not stat.S_ISREG(os.fstat(in_fd).st_mode):
+        return None
+
+    # a file object read from, by iteration in particular, may have
+    # buffered data beyond tell(), so only copy from files nothing was
+    # read from: those of accessors count the data read through them,
+    # others must not have moved
+    start = in_fh.tell()
+    if isinstance(in_fh, MeteredFile):
+        unread = in_fh.nbytes == 0
+    else:
+        unread = start == 0
+    if not unread or os.lseek(in_fd, 0, os.SEEK_CUR) != start:
+        return None
+
+    out_fh.flush()
+    offset = ctypes.c_int64(start)
+    while True:
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(offset), 1 << 30)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if offset.value == start and err in (errno.EINVAL, errno.ENOSYS):
+                return None
+            raise OSError(err, os.strerror(err))
+        if sent == 0:
+            break
+    in_fh.seek(offset.value)
+    copied = offset.value - start
+    if isinstance(in_fh, MeteredFile):
+        in_fh.account(copied)
+    return copied
+
+def relativeName(name):
+    """ Return the normalised relative name 'name', raising ValueError if
+    it is absolute or leaves the directory it is relative to. """
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == os.curdir or path.split(os.sep)[0] == os.pardir:
+        raise ValueError("%s: not below its base directory" % name)
+    return path
+
+def _bufferedCopy(in_fh, out_fh):
+    copied = 0
+    readinto = getattr(in_fh, 'readinto', None)
+    if readinto:
+        buf = bytearray(COPY_BUFSIZE)
+        view = memoryview(buf)
+    while True:
+        if readinto:
+            count = readinto(buf)
+            if not count:
+                break
+            out_fh.write(view[:count])
+        else:
+            data = in_fh.read(COPY_BUFSIZE)
+            if len(data) == 0:
+                break
+            count = len(data)
+            out_fh.write(data)
+        copied += count
+    return copied
+
+class TransferStats(object):
+    """ Transfer counters of an accessor, updated as the files it returns
+    are read and closed. """
+
+    # upper bounds (in ms) of the time-to-first-byte histogram buckets
+    TTFB_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.opens = 0
+        self.errors = 0
+        self.error_codes = {}
+        self.transfers = 0
+        self.bytes = 0
+        self.transfer_time = 0.0
+        self.ttfb_hist = [0] * (len(self.TTFB_BUCKETS) + 1)
+
+    def recordOpen(self):
+        with self.lock:
+            self.opens += 1
+
+    def recordError(self, code):
+        with self.lock:
+            self.errors += 1
+            self.error_codes[code] = self.error_codes.get(code, 0) + 1
+
+    def recordTransfer(self, nbytes, ttfb, elapsed):
+        with self.lock:
+            self.transfers += 1
+            self.bytes += nbytes
+            self.transfer_time += elapsed
+            if ttfb is not None:
+                ms = ttfb * 1000
+                bucket = 0
+                while (bucket < len(self.TTFB_BUCKETS) and
+                       ms > self.TTFB_BUCKETS[bucket]):
+                    bucket += 1
+                self.ttfb_hist[bucket] += 1
+
+    @staticmethod
+    def summary(nbytes, elapsed):
+        """ Return a description of a transfer of nbytes in elapsed
+        seconds, for logging. """
+        return "%d bytes in %.2fs (%.1f MiB/s)" % (
+            nbytes, elapsed, nbytes / (1024.0 * 1024) / max(elapsed, 1e-6))
+
+    def snapshot(self):
+        """ Return the current counters as a dict.  'ttfb_histogram' is a
+        list of (upper bound in ms, count) pairs, the last bound being None. """
+        with self.lock:
+            throughput = None
+            if self.transfer_time > 0:
+                throughput = self.bytes / self.transfer_time
+            return {'opens': self.opens,
+                    'errors': self.errors,
+                    'error_codes': dict(self.error_codes),
+                    'transfers': self.transfers,
+                    'bytes': self.bytes,
+                    'transfer_time': self.transfer_time,
+                    'throughput': throughput,
+                    'ttfb_histogram': zip(self.TTFB_BUCKETS + (None,),
+                                          self.ttfb_hist),
+                    }
+
+class MeteredFile(object):
+    """ Wrapper around a file object returned by an accessor, accounting
+    for the data read through it in the accessor's TransferStats.  The
+    counters are only merged on close() to keep reads cheap.  If given,
+    done(nbytes, elapsed) is also called on close(). """
+
+    def __init__(self, fh, stats, start, done = None):
+        self.fh = fh
+        self.stats = stats
+        self.start = start
+        self.done = done
+        self.first = None
+        self.last = start
+        self.nbytes = 0
+        if hasattr(fh, 'readinto'):
+            self.readinto = self._readinto
+
+    def account(self, nbytes):
+        if nbytes:
+            self.last = time.time()
+            if self.first is None:
+                self.first = self.last
+            self.nbytes += nbytes
+
+    def read(self, *args):
+        data = self.fh.read(*args)
+        self.account(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.fh.readline(*args)
+        self.account(len(data))
+        return data
+
+    def readlines(self, *args):
+        lines = self.fh.readlines(*args)
+        self.account(sum(len(l) for l in lines))
+        return lines
+
+    def _readinto(self, buf):
+        count = self.fh.readinto(buf)
+        self.account(count)
+        return count
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.stats:
+            ttfb = None
+            if self.first is not None:
+                ttfb = self.first - self.start
+            self.stats.recordTransfer(self.nbytes, ttfb, self.last - self.start)
+            self.stats = None
+            if self.done:
+                self.done(self.nbytes, self.last - self.start)
+        self.fh.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _startLocked(method):
+    """ Serialise calls to a start()/finish() method, so that an accessor
+    can be shared between threads. """
+    def wrapper(self, *args):
+        with self.start_lock:
+            return method(self, *args)
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
 class Accessor(object):
 
+    # upper bound on concurrent transfers issued by prefetch()/fetch_many()
+    max_transfers = 4
+
+    # whether finish() logs the transfer statistics
+    log_stats = False
+
+    # seconds network accessors wait to connect or for data, None for ever
+    timeout = None
+
     def __init__(self, ro):
         self.read_only = ro
+        self.start_lock = threading.RLock()
+        self.stats = TransferStats()
         self.lastError = 0
+        self.start_count = 0
+        # data readers may cache until the outermost finish()
+        self.session_cache = {}
+
+    def _getLastError(self):
+        return self._lastError
+
+    def _setLastError(self, code):
+        self._lastError = code
+        if code:
+            self.stats.recordError(code)
+
+    lastError = property(_getLastError, _setLastError)
+
+    def _metered(self, fh, start, done = None):
+        self.stats.recordOpen()
+        return MeteredFile(fh, self.stats, start, done)
+
+    def _logStats(self):
+        if self.log_stats:
+            logger.info("%r transfer statistics: %s" %
+                        (self, self.stats.snapshot()))
 
     def access(self, name):
         """ Return boolean determining where 'name' is an accessible object
@@ -75,20 +359,103 @@ class Accessor(object):
     def canEject(self):
         return False
 
-    def start(self):
+    def rename(self, old_name, new_name):
+        """should be overloaded"""
         pass
 
-    def finish(self):
+    def remove(self, name):
+        """should be overloaded"""
+        pass
+
+    def removeDir(self, name):
+        """should be overloaded"""
         pass
 
     @staticmethod
-    def _writeFile(in_fh, out_fh):
-        while out_fh:
-            data = in_fh.read(256 * 512)
-            if len(data) == 0:
-                break
-            out_fh.write(data)
+    def makeParent(path):
+        """ Create the missing directories above the local 'path'. """
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # already present, possibly created by another writer
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+    def transferWorkers(self, workers):
+        """ Return the number of concurrent transfers to use when
+        'workers' (None for the default) are asked for. """
+        if workers is None:
+            return self.max_transfers
+        return max(1, min(workers, self.max_transfers))
+
+    def prefetch(self, names, workers = None):
+        """ Read the objects 'names' concurrently, yielding (name, data)
+        tuples in completion order.  data is None if the object could not
+        be read. """
+        def fetch(name):
+            f = self.openAddress(name)
+            if not f:
+                return None
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+        for name, data, exc_info in parallel.iterCompleted(
+                fetch, names, self.transferWorkers(workers)):
+            if exc_info:
+                logger.debug("Failed to fetch %s: %s" % (name, exc_info[1]))
+            yield name, data
+
+    def fetch_many(self, names, dest, workers = None):
+        """ Copy the objects 'names' below the local directory 'dest'
+        concurrently, yielding (name, success) tuples in completion order. """
+        def fetch(name):
+            path = relativeName(name)
+            in_fh = self.openAddress(name)
+            if not in_fh:
+                return False
+            try:
+                out_name = os.path.join(dest, path)
+                self.makeParent(out_name)
+                return self.copyFile(in_fh, open(out_name, 'wb'))
+            finally:
+                in_fh.close()
+
+        for name, ok, exc_info in parallel.iterCompleted(
+                fetch, names, self.transferWorkers(workers)):
+            if exc_info:
+                logger.debug("Failed to fetch %s: %s" % (name, exc_info[1]))
+            yield name, bool(ok)
+
+    @_startLocked
+    def start(self):
+        self.start_count += 1
+
+    @_startLocked
+    def finish(self):
+        if self.start_count == 0:
+            return
+        self.start_count -= 1
+        if self.start_count == 0:
+            self._endSession()
+
+    def _endSession(self):
+        """ Called when the outermost start() is finished. """
+        self.session_cache.clear()
+        self._logStats()
+
+    @staticmethod
+    def copyFile(in_fh, out_fh):
+        """ Copy in_fh to out_fh, which is closed, in kernel space when
+        possible. """
+        start = time.time()
+        copied = _sendfileCopy(in_fh, out_fh)
+        if copied is None:
+            copied = _bufferedCopy(in_fh, out_fh)
         out_fh.close()
+
+        logger.info("Copied " + TransferStats.summary(copied, time.time() - start))
         return True
 
 class FilesystemAccessor(Accessor):
@@ -97,6 +464,7 @@ class FilesystemAccessor(Accessor):
         self.location = location
 
     def openAddress(self, addr):
+        start = time.time()
         try:
             file = open(os.path.join(self.location, addr), 'r')
         except OSError as e:
@@ -114,7 +482,7 @@ class FilesystemAccessor(Accessor):
         except Exception as e:
             self.lastError = 500
             return False
-        return file
+        return self._metered(file, start)
 
 class MountingAccessor(FilesystemAccessor):
     def __init__(self, mount_types, mount_source, mount_options = None):
@@ -126,9 +494,9 @@ class MountingAccessor(FilesystemAccessor):
         self.mount_options = mount_options
         self.start_count = 0
 
+    @_startLocked
     def start(self):
         if self.start_count == 0:
-            self.location = tempfile.mkdtemp(prefix="media-", dir="/tmp")
             # try each filesystem in turn:
             success = False
             for fs in self.mount_types:
@@ -140,32 +508,45 @@ class MountingAccessor(FilesystemAccessor):
                                 opts.append('ro')
                         else:
                             opts = ['ro']
-                    mount.mount(self.mount_source, self.location,
-                                options = opts,
-                                fstype = fs)
+                    # the mount may be shared with other accessors
+                    self.location = mount.registry.acquire(
+                        self.mount_source, fs, opts)
                 except mount.MountException:
                     continue
                 else:
                     success = True
                     break
             if not success:
-                os.rmdir(self.location)
                 raise mount.MountException
         self.start_count += 1
 
+    @_startLocked
     def finish(self):
         if self.start_count == 0:
             return
         self.start_count -= 1
         if self.start_count == 0:
-            mount.umount(self.location)
-            os.rmdir(self.location)
+            mount.registry.release(self.location)
             self.location = None
+            self._endSession()
 
     def writeFile(self, in_fh, out_name):
-        logger.info("Copying to %s" % os.path.join(self.location, out_name))
-        out_fh = open(os.path.join(self.location, out_name), 'w')
-        return self._writeFile(in_fh, out_fh)
+        path = os.path.join(self.location, out_name)
+        logger.info("Copying to %s" % path)
+        self.makeParent(path)
+        out_fh = open(path, 'wb')
+        return self.copyFile(in_fh, out_fh)
+
+    def rename(self, old_name, new_name):
+        path = os.path.join(self.location, new_name)
+        self.makeParent(path)
+        os.rename(os.path.join(self.location, old_name), path)
+
+    def remove(self, name):
+        os.unlink(os.path.join(self.location, name))
+
+    def removeDir(self, name):
+        os.rmdir(os.path.join(self.location, name))
 
     def __del__(self):
         while self.start_count > 0:
@@ -218,6 +599,7 @@ class FileAccessor(Accessor):
         self.baseAddress = baseAddress
 
     def openAddress(self, address):
+        start = time.time()
         try:
             file = open(os.path.join(self.baseAddress, address))
         except IOError as e:
@@ -235,12 +617,25 @@ class FileAccessor(Accessor):
         except Exception as e:
             self.lastError = 500
             return False
-        return file
+        return self._metered(file, start)
 
     def writeFile(self, in_fh, out_name):
-        logger.info("Copying to %s" % os.path.join(self.baseAddress, out_name))
-        out_fh = open(os.path.join(self.baseAddress, out_name), 'w')
-        return self._writeFile(in_fh, out_fh)
+        path = os.path.join(self.baseAddress, out_name)
+        logger.info("Copying to %s" % path)
+        self.makeParent(path)
+        out_fh = open(path, 'wb')
+        return self.copyFile(in_fh, out_fh)
+
+    def rename(self, old_name, new_name):
+        path = os.path.join(self.baseAddress, new_name)
+        self.makeParent(path)
+        os.rename(os.path.join(self.baseAddress, old_name), path)
+
+    def remove(self, name):
+        os.unlink(os.path.join(self.baseAddress, name))
+
+    def removeDir(self, name):
+        os.rmdir(os.path.join(self.baseAddress, name))
 
     def __repr__(self):
         return "<FileAccessor: %s>" % self.baseAddress
@@ -256,6 +651,9 @@ def rebuild_url(url_parts):
          url_parts.path, '', ''))
 
 class FTPAccessor(Accessor):
+    # transfers share the single control connection
+    max_transfers = 1
+
     def __init__(self, baseAddress, ro):
         super(FTPAccessor, self).__init__(ro)
         self.url_parts = urlparse.urlsplit(baseAddress, allow_fragments=False)
@@ -270,9 +668,13 @@ class FTPAccessor(Accessor):
             self.ftp.voidresp()
             self.cleanup = False
 
+    @_startLocked
     def start(self):
         if self.start_count == 0:
-            self.ftp = ftplib.FTP()
+            if self.timeout is None:
+                self.ftp = ftplib.FTP()
+            else:
+                self.ftp = ftplib.FTP(timeout = self.timeout)
             #self.ftp.set_debuglevel(1)
             port = ftplib.FTP_PORT
             if self.url_parts.port:
@@ -293,6 +695,7 @@ class FTPAccessor(Accessor):
 
         self.start_count += 1
 
+    @_startLocked
     def finish(self):
         if self.start_count == 0:
             return
@@ -301,6 +704,7 @@ class FTPAccessor(Accessor):
             self.ftp.quit()
             self.cleanup = False
             self.ftp = None
+            self._endSession()
 
     def access(self, path):
         try:
@@ -330,21 +734,52 @@ class FTPAccessor(Accessor):
 
     def openAddress(self, address):
         logger.debug("Opening "+address)
+        start = time.time()
         self._cleanup()
         url = urllib.unquote(address)
 
         self.ftp.voidcmd('TYPE I')
-        s = self.ftp.transfercmd('RETR ' + url).makefile('rb')
+        try:
+            s = self.ftp.transfercmd('RETR ' + url).makefile('rb')
+        except ftplib.error_perm as e:
+            self.lastError = 404 if str(e).startswith('550') else 500
+            return False
         self.cleanup = True
-        return s
+        return self._metered(s, start)
 
     def writeFile(self, in_fh, out_name):
         self._cleanup()
         fname = urllib.unquote(out_name)
 
+        self._makeRemoteParent(fname)
         logger.debug("Storing as " + fname)
         self.ftp.storbinary('STOR ' + fname, in_fh)
 
+    def _makeRemoteParent(self, fname):
+        # create any missing parent directories
+        parent = ''
+        for part in os.path.dirname(fname).split('/'):
+            if part:
+                parent = os.path.join(parent, part)
+                try:
+                    self.ftp.mkd(parent)
+                except ftplib.error_perm:
+                    pass
+
+    def rename(self, old_name, new_name):
+        self._cleanup()
+        new_name = urllib.unquote(new_name)
+        self._makeRemoteParent(new_name)
+        self.ftp.rename(urllib.unquote(old_name), new_name)
+
+    def remove(self, name):
+        self._cleanup()
+        self.ftp.delete(urllib.unquote(name))
+
+    def removeDir(self, name):
+        self._cleanup()
+        self.ftp.rmd(urllib.unquote(name))
+
     def __repr__(self):
         return "<FTPAccessor: %s>" % self.baseAddress
 
@@ -371,16 +806,319 @@ class HTTPAccessor(Accessor):
         self.baseAddress = rebuild_url(self.url_parts)
 
     def openAddress(self, address):
+        start = time.time()
+        url = os.path.join(self.baseAddress, address)
         try:
-            urlFile = urllib2.urlopen(os.path.join(self.baseAddress, address))
+            if self.timeout is None:
+                urlFile = urllib2.urlopen(url)
+            else:
+                urlFile = urllib2.urlopen(url, timeout = self.timeout)
         except urllib2.HTTPError as e:
             self.lastError = e.code
             return False
-        return urlFile
+        return self._metered(urlFile, start)
 
     def __repr__(self):
         return "<HTTPAccessor: %s>" % self.baseAddress
 
+class _MirrorFile(object):
+    """ File of a MirrorAccessor which, when a read from its mirror fails,
+    reopens the address on the next mirror and skips the data already
+    read. """
+
+    def __init__(self, accessor, address, mirror, fh):
+        self.accessor = accessor
+        self.address = address
+        self.mirror = mirror
+        self.fh = fh
+        self.offset = 0
+        self.tried = set([mirror])
+
+    def _reopen(self, error):
+        logger.warning("Failed to read %s from %r: %s" %
+                       (self.address, self.mirror, error))
+        self.accessor._fail(self.mirror)
+        try:
+            self.fh.close()
+        except Exception:
+            pass
+        for mirror in self.accessor.ranking():
+            if mirror in self.tried:
+                continue
+            self.tried.add(mirror)
+            try:
+                fh = mirror.openAddress(self.address)
+                if not fh:
+                    continue
+                skip = self.offset
+                while skip > 0:
+                    data = fh.read(min(skip, COPY_BUFSIZE))
+                    if not data:
+                        raise IOError("%s shorter than on %r" %
+                                      (self.address, self.mirror))
+                    skip -= len(data)
+            except Exception as e:
+                logger.warning("Failed to resume %s on %r: %s" %
+                               (self.address, mirror, e))
+                self.accessor._fail(mirror)
+                continue
+            logger.info("Resuming %s at %d on %r" %
+                        (self.address, self.offset, mirror))
+            self.mirror = mirror
+            self.fh = fh
+            return True
+        return False
+
+    def _call(self, method, *args):
+        while True:
+            try:
+                data = getattr(self.fh, method)(*args)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if not self._reopen(e):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                continue
+            self.offset += len(data)
+            return data
+
+    def read(self, *args):
+        return self._call('read', *args)
+
+    def readline(self, *args):
+        return self._call('readline', *args)
+
+    def readlines(self, *args):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fh.close()
+
+class MirrorAccessor(Accessor):
+    """ Read-only accessor over several mirrors of the same tree, which may
+    use any of the SUPPORTED_ACCESSORS schemes.
+
+    On start() each mirror is ranked by the time taken to read the small
+    'probe' object, and the files listed in 'verify' (by default the
+    metadata of an XS repository) are compared by md5 across mirrors,
+    excluding those disagreeing with the majority for the session.  start()
+    raises IOError if no mirror is left.  Each
+    request goes to the best usable mirror, falling over to the next one on
+    errors.  A read failing part way, for instance when the mirror stops
+    sending data for 'timeout' seconds, carries on from the next mirror,
+    which is read from the start up to the same offset.  A mirror failing,
+    or whose throughput collapses below collapse_ratio of the best it
+    achieved, is skipped for retry_interval seconds. """
+
+    retry_interval = 60
+    # given to mirrors not setting their own, and bounding the probes
+    timeout = 30
+    collapse_ratio = 0.2
+    # transfers smaller than this say little about throughput
+    min_sample = 64 * 1024
+
+    def __init__(self, baseAddresses, ro, probe = '.treeinfo',
+                 verify = ('XS-REPOSITORY', 'XS-PACKAGES')):
+        super(MirrorAccessor, self).__init__(ro)
+        self.mirrors = [createAccessor(addr, ro) for addr in baseAddresses]
+        for mirror in self.mirrors:
+            if mirror.timeout is None:
+                mirror.timeout = self.timeout
+        self.probe = probe
+        self.verify = verify
+        self.max_transfers = min(m.max_transfers for m in self.mirrors)
+        self.start_count = 0
+        self.lock = threading.Lock()
+        self.started = []
+        self.excluded = set()
+        self.latency = {}
+        self.throughput = {}
+        self.peak = {}
+        self.failed = {}
+
+    def _probe(self, mirror):
+        start = time.time()
+        fh = mirror.openAddress(self.probe)
+        if not fh:
+            return None
+        try:
+            fh.read()
+        finally:
+            fh.close()
+        return time.time() - start
+
+    @_startLocked
+    def start(self):
+        if self.start_count == 0:
+            self.started = []
+            self.excluded = set()
+            for mirror in self.mirrors:
+                try:
+                    mirror.start()
+                except Exception as e:
+                    logger.warning("Failed to start %r: %s" % (mirror, e))
+                    self.excluded.add(mirror)
+                else:
+                    self.started.append(mirror)
+
+            if self.probe:
+                self._probeAll()
+            if self.verify:
+                self.checkConsistency(self.verify)
+            if not self.usable():
+                for mirror in self.started:
+                    mirror.finish()
+                self.started = []
+                self.lastError = 500
+                raise IOError("No usable mirror of %r" % self)
+        self.start_count += 1
+
+    def _probeAll(self):
+        """ Probe the usable mirrors concurrently, failing those which
+        do not answer within 'timeout' seconds.  Their threads are left to
+        end on their own. """
+        results = {}
+        def probe(mirror):
+            try:
+                results[mirror] = (self._probe(mirror), None)
+            except Exception as e:
+                results[mirror] = (None, e)
+
+        threads = []
+        for mirror in self.usable():
+            t = threading.Thread(target = probe, args = (mirror,))
+            t.daemon = True
+            t.start()
+            threads.append((mirror, t))
+        deadline = time.time() + self.timeout
+        for _, t in threads:
+            t.join(max(0, deadline - time.time()))
+
+        results = dict(results)
+        for mirror, _ in threads:
+            latency, error = results.get(mirror, (None, "timed out"))
+            if error:
+                logger.warning("Failed to probe %r: %s" % (mirror, error))
+                self._fail(mirror)
+            self.latency[mirror] = latency
+
+    @_startLocked
+    def finish(self):
+        if self.start_count == 0:
+            return
+        self.start_count -= 1
+        if self.start_count == 0:
+            for mirror in self.started:
+                mirror.finish()
+            self.started = []
+            self._endSession()
+
+    def usable(self):
+        return [m for m in self.mirrors if m not in self.excluded]
+
+    def ranking(self):
+        """ Return usable mirrors, best first. """
+        now = time.time()
+        def key(mirror):
+            latency = self.latency.get(mirror)
+            return (now - self.failed.get(mirror, 0) < self.retry_interval,
+                    -self.throughput.get(mirror, 0),
+                    latency is None, latency)
+        with self.lock:
+            return sorted(self.usable(), key = key)
+
+    def _fail(self, mirror):
+        with self.lock:
+            self.failed[mirror] = time.time()
+            self.throughput.pop(mirror, None)
+            self.peak.pop(mirror, None)
+
+    def _transferDone(self, mirror, nbytes, elapsed):
+        if nbytes < self.min_sample or elapsed <= 0:
+            return
+        rate = nbytes / elapsed
+        with self.lock:
+            ewma = self.throughput.get(mirror, rate) * 0.7 + rate * 0.3
+            self.throughput[mirror] = ewma
+            self.peak[mirror] = max(self.peak.get(mirror, 0), rate)
+            collapsed = ewma < self.collapse_ratio * self.peak[mirror]
+        if collapsed:
+            logger.warning("Throughput of %r collapsed to %d B/s" %
+                           (mirror, ewma))
+            self._fail(mirror)
+
+    def openAddress(self, address):
+        start = time.time()
+        self.lastError = 0
+        for mirror in self.ranking():
+            try:
+                fh = mirror.openAddress(address)
+            except Exception as e:
+                logger.warning("Failed to open %s on %r: %s" %
+                               (address, mirror, e))
+                self._fail(mirror)
+                self.lastError = 500
+                continue
+            if fh:
+                mirror_fh = _MirrorFile(self, address, mirror, fh)
+                def done(nbytes, elapsed):
+                    self._transferDone(mirror_fh.mirror, nbytes, elapsed)
+                return self._metered(mirror_fh, start, done)
+            if mirror.lastError != 404:
+                self._fail(mirror)
+            self.lastError = mirror.lastError
+        if not self.lastError:
+            # no usable mirror to try
+            self.lastError = 500
+        return False
+
+    def checkConsistency(self, names):
+        """ Compare the md5 of the objects 'names' across mirrors, and
+        exclude mirrors disagreeing with the majority.  Returns the list of
+        mirrors excluded. """
+        def digests(mirror):
+            ret = []
+            for name in names:
+                fh = mirror.openAddress(name)
+                if not fh:
+                    ret.append(None)
+                    continue
+                try:
+                    ret.append(hashlib.md5(fh.read()).hexdigest())
+                finally:
+                    fh.close()
+            return tuple(ret)
+
+        mirrors = self.usable()
+        found = {}
+        votes = {}
+        for mirror, value, exc_info in parallel.iterCompleted(
+                digests, mirrors, len(mirrors)):
+            if exc_info:
+                continue
+            found[mirror] = value
+            votes[value] = votes.get(value, 0) + 1
+        if not votes:
+            return []
+        majority = max(votes, key = lambda v: (votes[v], None not in v))
+
+        bad = [m for m in mirrors if found.get(m) != majority]
+        for mirror in bad:
+            logger.warning("Excluding inconsistent mirror %r" % mirror)
+            self.excluded.add(mirror)
+        return bad
+
+    def __repr__(self):
+        return "<MirrorAccessor: %s>" % ', '.join(repr(m) for m in self.mirrors)
+
 SUPPORTED_ACCESSORS = {'nfs': NFSAccessor,
                        'http': HTTPAccessor,
                        'https': HTTPAccessor,
@@ -390,6 +1128,9 @@ SUPPORTED_ACCESSORS = {'nfs': NFSAccessor,
                        }
 
 def createAccessor(baseAddress, *args):
+    if isinstance(baseAddress, list):
+        return MirrorAccessor(baseAddress, *args)
+
     url_parts = urlparse.urlsplit(baseAddress, allow_fragments=False)
 
     assert url_parts.scheme in SUPPORTED_ACCESSORS.keys()
@@ -23,11 +23,14 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import atexit
 import os
 import os.path
 import tempfile
+import threading
 
 import xcp.cmd
+import xcp.logger as logger
 
 class MountException(Exception):
     pass
@@ -88,3 +91,117 @@ class TempMount(object):
             self.mounted = False
         if os.path.isdir(self.mount_point):
             os.rmdir(self.mount_point)
+
+class _SharedMount(object):
+    def __init__(self, key):
+        self.key = key
+        # None until mounted; mounting and unmounting hold lock
+        self.mountpoint = None
+        self.lock = threading.Lock()
+        self.users = 0
+        self.timer = None
+
+class MountRegistry(object):
+    """ Mounts shared by all users of the same (source, fstype, options)
+    within the process.  A mount is released when its last user lets go
+    of it, after idle_timeout seconds if that is non-zero, so that short
+    lived users do not mount and unmount the same source over and over.
+
+    The registry lock only guards the tables and use counts: mounting and
+    unmounting hold the lock of their entry, so that a slow mount does not
+    hold up users of other sources. """
+
+    def __init__(self, idle_timeout = 0):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.mounts = {}
+        self.by_mountpoint = {}
+
+    def acquire(self, source, fstype = None, options = None,
+                tmp_prefix = "media-"):
+        """ Return a mountpoint where source is mounted, mounting it if
+        needed.  Raises MountException on failure. """
+        key = (source, fstype, tuple(options or ()))
+        with self.lock:
+            entry = self.mounts.get(key)
+            if not entry:
+                entry = _SharedMount(key)
+                self.mounts[key] = entry
+            entry.users += 1
+            if entry.timer:
+                entry.timer.cancel()
+                entry.timer = None
+
+        with entry.lock:
+            if entry.mountpoint:
+                return entry.mountpoint
+            mountpoint = tempfile.mkdtemp(prefix = tmp_prefix, dir = "/tmp")
+            try:
+                mount(source, mountpoint, options and list(options) or None,
+                      fstype)
+            except:
+                os.rmdir(mountpoint)
+                with self.lock:
+                    entry.users -= 1
+                    if entry.users == 0 and self.mounts.get(key) is entry:
+                        del self.mounts[key]
+                raise
+            with self.lock:
+                entry.mountpoint = mountpoint
+                self.by_mountpoint[mountpoint] = entry
+            return mountpoint
+
+    def release(self, mountpoint):
+        """ Drop a reference obtained from acquire(). """
+        with self.lock:
+            entry = self.by_mountpoint[mountpoint]
+            entry.users -= 1
+            if entry.users > 0:
+                return
+            if self.idle_timeout > 0:
+                entry.timer = threading.Timer(self.idle_timeout, self._expire,
+                                              [entry])
+                entry.timer.daemon = True
+                entry.timer.start()
+                return
+            self._detach(entry)
+        self._unmount(entry)
+
+    def _expire(self, entry):
+        with self.lock:
+            # a timer cancelled too late finds another one, or none
+            if (entry.users > 0 or entry.timer is not threading.current_thread() or
+                self.mounts.get(entry.key) is not entry):
+                return
+            self._detach(entry)
+        try:
+            self._unmount(entry)
+        except Exception as e:
+            logger.error("Failed to unmount idle %s: %s" % (entry.mountpoint, e))
+
+    def _detach(self, entry):
+        """ Remove an unused entry from the tables, with the registry lock
+        held, so that no new user can find it. """
+        del self.mounts[entry.key]
+        del self.by_mountpoint[entry.mountpoint]
+        entry.timer = None
+
+    def _unmount(self, entry):
+        with entry.lock:
+            umount(entry.mountpoint)
+            os.rmdir(entry.mountpoint)
+
+    def flush(self):
+        """ Unmount all mounts which are not in use. """
+        with self.lock:
+            idle = [entry for entry in self.mounts.values()
+                    if entry.users == 0 and entry.mountpoint]
+            for entry in idle:
+                if entry.timer:
+                    entry.timer.cancel()
+                self._detach(entry)
+        for entry in idle:
+            self._unmount(entry)
+
+registry = MountRegistry()
+atexit.register(registry.flush)
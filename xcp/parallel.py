@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013, Citrix Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""parallel - run I/O bound jobs on a bounded set of threads"""
+
+import sys
+import threading
+import Queue
+
+def iterCompleted(func, items, workers):
+    """ Call func(item) for each of items using at most 'workers' threads.
+
+    Yields (item, result, exc_info) tuples in completion order, exc_info
+    being None when func returned normally.  With a single worker the
+    calls are made in order from the calling thread. """
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception:
+                yield item, None, sys.exc_info()
+        return
+
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception:
+                done.put((item, None, sys.exc_info()))
+
+    threads = []
+    for _ in range(min(workers, len(items))):
+        t = threading.Thread(target = worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    try:
+        for _ in items:
+            yield done.get()
+    finally:
+        # stop handing out work if the consumer gave up early
+        stop.set()
+        for t in threads:
+            t.join()
+
+def mapOrdered(func, items, workers):
+    """ Like map(func, items) but using at most 'workers' threads.
+
+    The first exception raised by func (in item order) is re-raised once
+    all calls have completed. """
+
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    def call(job):
+        return func(job[1])
+
+    for (i, _), result, exc_info in iterCompleted(call, enumerate(items),
+                                                  workers):
+        results[i] = result
+        errors[i] = exc_info
+
+    for exc_info in errors:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
@@ -21,9 +21,15 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import bisect
+import mmap
 import os.path
+import struct
 import subprocess
 import re
+import tempfile
+
+import xcp.logger as logger
 
 _SBDF = (r"(?:(?P<segment> [\da-dA-F]{4}):)?" # Segment (optional)
          "     (?P<bus>     [\da-fA-F]{2}):"   # Bus
@@ -41,6 +47,11 @@ VALID_SBDFI = re.compile(
     , re.X)
 
 
+# words of the PCI class names, for PCIIds.lookupClass()
+_WORD = re.compile(r"[a-z0-9]+")
+_NOT_WORD = re.compile(r"[^a-z0-9]+")
+
+
 class PCI(object):
     """PCI address object for manipulation and comparison"""
 
@@ -228,9 +239,13 @@ class PCIIds(object):
         fh.close()
 
     @classmethod
-    def read(cls):
+    def read(cls, index = None):
+        """ Return the database of the system's pci.ids.  If 'index' is
+        given, a PCIIdsIndex using that index file is returned instead. """
         for f in ['/usr/share/hwdata/pci.ids']:
             if os.path.exists(f):
+                if index:
+                    return PCIIdsIndex(f, index)
                 return cls(f)
         raise Exception, 'Failed to open PCI database'
 
@@ -245,17 +260,315 @@ class PCIIds(object):
         key = "%s:%s" % (subvendor, subdevice)
         return key in self.sub_dict and self.sub_dict[key] or None
 
+    # (classes, word -> class positions, sorted words) of the class names
+    _class_index = None
+
+    def _classIndex(self):
+        if self._class_index is None:
+            classes = [k for k, (c, sc) in self.class_dict.items() if not sc]
+            words = {}
+            for pos, k in enumerate(classes):
+                for word in set(_WORD.findall(self.class_dict[k][0].lower())):
+                    words.setdefault(word, []).append(pos)
+            self._class_index = (classes, words, sorted(words))
+        return self._class_index
+
+    def _classesWithPrefix(self, prefix):
+        _, words, vocabulary = self._classIndex()
+        positions = set()
+        i = bisect.bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            positions.update(words[vocabulary[i]])
+            i += 1
+        return positions
+
     def lookupClass(self, cls_str):
-        ret = []
-        for k, (c, sc) in self.class_dict.items():
-            if not sc and cls_str in c and k not in ret:
-                ret.append(k)
-        return ret
+        """ Return the classes whose name contains cls_str. """
+        classes, words, vocabulary = self._classIndex()
+        fragments = _NOT_WORD.split(cls_str.lower())
+        # fragments after the first start a word of the matching names
+        tail = max(fragments[1:], key = len) if len(fragments) > 1 else ''
+        if tail:
+            positions = self._classesWithPrefix(tail)
+        elif fragments[0]:
+            positions = set()
+            for word in vocabulary:
+                if fragments[0] in word:
+                    positions.update(words[word])
+        else:
+            positions = range(len(classes))
+        return [classes[pos] for pos in sorted(positions)
+                if cls_str in self.class_dict[classes[pos]][0]]
+
+    def lookupClassWords(self, query, prefix = False):
+        """ Return the classes whose name contains all the words of query,
+        ignoring case.  With prefix=True the last word may be incomplete. """
+        classes, words, _ = self._classIndex()
+        query = _WORD.findall(query.lower())
+        if not query:
+            return []
+        positions = None
+        for i, word in enumerate(query):
+            if prefix and i == len(query) - 1:
+                found = self._classesWithPrefix(word)
+            else:
+                found = set(words.get(word, ()))
+            positions = found if positions is None else positions & found
+        return [classes[pos] for pos in sorted(positions)]
+
+class PCIIdsIndex(PCIIds):
+    """ PCIIds answering vendor, device and subdevice queries from a binary
+    index of the pci.ids file, memory-mapped rather than parsed.
+
+    The index is compiled from the text when missing or truncated, or when
+    the size or modification time of the pci.ids it was built from
+    changed.  It is written readable by all, to be shared.  It holds
+    a header, sorted (key, offset, length) records per table, keyed by the
+    integer ids, and the texts.  Only class_dict is provided of the PCIIds
+    tables.  If the index cannot be written it is kept in memory. """
+
+    MAGIC = "XCPPCIID"
+    FORMAT = 2
+
+    # magic, format, source mtime and size, length of the index, then
+    # (start, count) per table
+    _header = struct.Struct("<8sIdqQ" + "II" * 4)
+    _record = struct.Struct("<III")
+    _key = struct.Struct("<I")
+
+    VENDORS, DEVICES, SUBDEVICES, CLASSES = range(4)
+
+    def __init__(self, fn, index_fn):
+        self.source = fn
+        self.index = index_fn
+        self.data = None
+        self._class_dict = None
+
+        st = os.stat(fn)
+        try:
+            with open(index_fn, 'rb') as fh:
+                data = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+            if self._valid(data, st):
+                self.data = data
+            else:
+                data.close()
+        except (EnvironmentError, ValueError):
+            # missing, or empty
+            pass
+
+        if self.data is None:
+            self.data = self._compile(fn, st)
+            try:
+                dirname = os.path.dirname(os.path.abspath(index_fn))
+                fd, tmp = tempfile.mkstemp(dir = dirname, prefix = ".pciids")
+                with os.fdopen(fd, 'wb') as fh:
+                    fh.write(self.data)
+                # shared by all users, unlike mkstemp()'s default
+                os.chmod(tmp, 0644)
+                os.rename(tmp, index_fn)
+            except (IOError, OSError) as e:
+                logger.info("Failed to write PCI ids index %s: %s" % (index_fn, e))
+
+        header = self._header.unpack_from(self.data, 0)
+        self.tables = zip(header[5::2], header[6::2])
+        self.text_start = (self._header.size +
+                           sum(header[6::2]) * self._record.size)
+
+    def _valid(self, data, st):
+        if len(data) < self._header.size:
+            return False
+        magic, fmt, mtime, size, length = self._header.unpack_from(data, 0)[:5]
+        # a truncated index is stale too
+        return (magic == self.MAGIC and fmt == self.FORMAT and
+                mtime == st.st_mtime and size == st.st_size and
+                length == len(data))
+
+    @classmethod
+    def _compile(cls, fn, st):
+        """ Return the index of pci.ids file 'fn' as a string. """
+        ids = PCIIds(fn)
+        tables = [[], [], [], []]
+        for vendor, text in ids.vendor_dict.items():
+            tables[cls.VENDORS].append((cls._ids(vendor), text))
+        for key, text in ids.main_dict.items():
+            tables[cls.DEVICES].append((cls._ids(*key.split(':')), text))
+        for key, text in ids.sub_dict.items():
+            tables[cls.SUBDEVICES].append((cls._ids(*key.split(':')), text))
+        for key, (text, sub_text) in ids.class_dict.items():
+            if sub_text is None:
+                tables[cls.CLASSES].append((cls._classKey(key), text))
+            else:
+                tables[cls.CLASSES].append((cls._classKey(*key.split(':')), sub_text))
+
+        texts = []
+        text_len = 0
+        records = []
+        counts = []
+        for table in tables:
+            table = sorted((k, t) for k, t in table if k is not None)
+            counts.append(len(table))
+            for key, text in table:
+                records.append(cls._record.pack(key, text_len, len(text)))
+                texts.append(text)
+                text_len += len(text)
+
+        length = cls._header.size + len(records) * cls._record.size + text_len
+        header = [cls.MAGIC, cls.FORMAT, st.st_mtime, st.st_size, length]
+        start = cls._header.size
+        for count in counts:
+            header += [start, count]
+            start += count * cls._record.size
+        return cls._header.pack(*header) + ''.join(records) + ''.join(texts)
+
+    @staticmethod
+    def _ids(*ids):
+        """ Return the integer key of 16 bit hex ids, None if invalid. """
+        key = 0
+        for i in ids:
+            if len(i) != 4:
+                return None
+            try:
+                key = key << 16 | int(i, 16)
+            except ValueError:
+                return None
+        return key
+
+    @staticmethod
+    def _classKey(cls, sub_cls = None):
+        """ Return the integer key of a class or subclass, None if invalid.
+        Classes sort before their subclasses. """
+        if len(cls) != 2 or (sub_cls is not None and len(sub_cls) != 2):
+            return None
+        try:
+            key = int(cls, 16) << 9
+            if sub_cls is not None:
+                key |= 0x100 | int(sub_cls, 16)
+        except ValueError:
+            return None
+        return key
+
+    def _records(self, table):
+        start, count = self.tables[table]
+        for i in range(count):
+            yield self._record.unpack_from(self.data, start + i * self._record.size)
+
+    def _find(self, table, key):
+        if key is None:
+            return None
+        start, count = self.tables[table]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._key.unpack_from(self.data, start + mid * self._record.size)[0]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                _, offset, length = self._record.unpack_from(
+                    self.data, start + mid * self._record.size)
+                return self._text(offset, length)
+        return None
+
+    def _text(self, offset, length):
+        offset += self.text_start
+        return self.data[offset:offset + length]
+
+    @property
+    def class_dict(self):
+        if self._class_dict is None:
+            class_dict = {}
+            class_texts = {}
+            for key, offset, length in self._records(self.CLASSES):
+                cls = "%02x" % (key >> 9)
+                if key & 0x100:
+                    class_dict["%s:%02x" % (cls, key & 0xff)] = (
+                        class_texts.get(cls), self._text(offset, length))
+                else:
+                    class_texts[cls] = self._text(offset, length)
+                    class_dict[cls] = (class_texts[cls], None)
+            self._class_dict = class_dict
+        return self._class_dict
+
+    def findVendor(self, vendor):
+        return self._find(self.VENDORS, self._ids(vendor)) or None
+
+    def findDevice(self, vendor, device):
+        return self._find(self.DEVICES, self._ids(vendor, device)) or None
+
+    def findSubdevice(self, subvendor, subdevice):
+        return self._find(self.SUBDEVICES, self._ids(subvendor, subdevice)) or None
 
 class PCIDevices(object):
-    def __init__(self):
+    def __init__(self, sysfs_root = '/'):
+        """ Enumerate the PCI devices from sysfs under 'sysfs_root', or
+        using lspci if it is None or sysfs is not available there. """
         self.devs = {}
 
+        sysfs_devices = None
+        if sysfs_root is not None:
+            sysfs_devices = os.path.join(sysfs_root, 'sys/bus/pci/devices')
+        if sysfs_devices and os.path.isdir(sysfs_devices):
+            self._readSysfs(sysfs_devices)
+        else:
+            self._readLspci()
+        self._index()
+
+    @staticmethod
+    def _slot(dev_id):
+        left, _ = dev_id.rsplit('.', 1)
+        return left
+
+    def _index(self):
+        """ Build the lookup tables of the find methods, which keep the
+        order of devs.  They must be rebuilt if devs is modified. """
+        self.by_class = {}
+        self.by_subclass = {}
+        self.by_vendor = {}
+        self.by_device = {}
+        self.by_slot = {}
+        self._position = {}
+        for pos, dev in enumerate(self.devs.values()):
+            self._position[dev['id']] = pos
+            self.by_class.setdefault(dev['class'], []).append(dev)
+            self.by_subclass.setdefault((dev['class'], dev['subclass']), []).append(dev)
+            self.by_vendor.setdefault(dev['vendor'], []).append(dev)
+            self.by_device.setdefault((dev['vendor'], dev['device']), []).append(dev)
+            self.by_slot.setdefault(self._slot(dev['id']), []).append(dev['id'])
+
+    @staticmethod
+    def _readId(path):
+        """ Return the contents of a sysfs id file, without the 0x. """
+        with open(path) as fh:
+            value = fh.read().strip()
+        if value.startswith('0x'):
+            value = value[2:]
+        return value
+
+    def _readSysfs(self, sysfs_devices):
+        addrs = os.listdir(sysfs_devices)
+        # like lspci, only show the domains if some are not 0
+        strip_domain = all(addr.startswith('0000:') for addr in addrs)
+        for addr in addrs:
+            path = os.path.join(sysfs_devices, addr)
+            dev_id = addr[5:] if strip_domain else addr
+            cls = self._readId(os.path.join(path, 'class'))
+            dev = {'id': dev_id,
+                   'class': cls[:2],
+                   'subclass': cls[2:4],
+                   'vendor': self._readId(os.path.join(path, 'vendor')),
+                   'device': self._readId(os.path.join(path, 'device'))}
+            try:
+                subvendor = self._readId(os.path.join(path, 'subsystem_vendor'))
+                subdevice = self._readId(os.path.join(path, 'subsystem_device'))
+            except IOError:
+                subvendor = subdevice = '0000'
+            if subvendor != '0000' or subdevice != '0000':
+                dev['subvendor'] = subvendor
+                dev['subdevice'] = subdevice
+            self.devs[dev_id] = dev
+
+    def _readLspci(self):
         cmd = subprocess.Popen(['lspci', '-mn'], bufsize = 1,
                                stdout = subprocess.PIPE)
         for l in cmd.stdout:
@@ -279,21 +592,159 @@ class PCIDevices(object):
         	[class1, class2, ... classN]"""
         if subcls:
             assert isinstance(cls, str)
-            return filter(lambda x: x['class'] == cls and
-                          x['subclass'] == subcls, self.devs.values())
+            return list(self.by_subclass.get((cls, subcls), []))
         else:
             assert isinstance(cls, list)
-            return filter(lambda x: x['class'] in cls, self.devs.values())
+            found = []
+            for c in set(cls):
+                found.extend(self.by_class.get(c, []))
+            if len(cls) > 1:
+                found.sort(key = lambda x: self._position[x['id']])
+            return found
+
+    def findByVendor(self, vendor, device = None):
+        """ return all devices of vendor, and device if given"""
+        if device:
+            return list(self.by_device.get((vendor, device), []))
+        return list(self.by_vendor.get(vendor, []))
+
+    def findFunctions(self, slot):
+        """ return the devices of a bus & slot, such as '00:18'"""
+        return list(self.by_slot.get(slot, []))
 
     def findRelatedFunctions(self, dev):
         """ return other devices that share the same bus & slot"""
-        def slot(dev):
-            left, _ = dev.rsplit('.', 1)
-            return left
-
-        return filter(lambda x: x != dev and slot(x) == slot(dev),
-                      self.devs.keys())
-
+        return [x for x in self.by_slot.get(self._slot(dev), []) if x != dev]
+
+
+def _parseCpuList(cpulist):
+    """ Return the set of cpus of a sysfs cpu list such as '0-3,8'. """
+    cpus = set()
+    for part in cpulist.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return frozenset(cpus)
+
+# sysfs name of a PCI device, whose domain may be any hex (000e:) and
+# wider than four digits behind a VMD controller (10000:)
+_SYSFS_DEVICE = re.compile(r"^[\da-fA-F]{4,}:[\da-fA-F]{2}:[\da-fA-F]{2}\.[0-7]$")
+
+class PCITopology(object):
+    """ The PCI device hierarchy and NUMA locality read from sysfs under
+    'sysfs_root'.
+
+    Devices are named by their full sysfs address (0000:01:00.0), though
+    queries also accept addresses without the segment.  Ancestors,
+    descendants and NUMA nodes are precomputed so the queries take
+    constant time. """
+
+    def __init__(self, sysfs_root = '/'):
+        sysfs_devices = os.path.join(sysfs_root, 'sys/bus/pci/devices')
+
+        self.parent = {}
+        self.numa_node = {}
+        self.local_cpus = {}
+        self.sriov_numvfs = {}
+        self.physfn = {}
+
+        for addr in os.listdir(sysfs_devices):
+            link = os.path.join(sysfs_devices, addr)
+            parent = os.path.basename(os.path.dirname(os.path.realpath(link)))
+            # devices hang off a bridge, or off the host bridge pciSSSS:BB
+            self.parent[addr] = parent if _SYSFS_DEVICE.match(parent) else None
+
+            node = self._read(link, 'numa_node')
+            if node is not None and int(node) >= 0:
+                self.numa_node[addr] = int(node)
+            cpulist = self._read(link, 'local_cpulist')
+            if cpulist is not None:
+                self.local_cpus[addr] = _parseCpuList(cpulist)
+            numvfs = self._read(link, 'sriov_numvfs')
+            if numvfs is not None:
+                self.sriov_numvfs[addr] = int(numvfs)
+            physfn = os.path.join(link, 'physfn')
+            if os.path.islink(physfn):
+                self.physfn[addr] = os.path.basename(os.path.realpath(physfn))
+
+        # nearest first
+        self.ancestors = {}
+        for addr in self.parent:
+            chain = []
+            parent = self.parent[addr]
+            while parent is not None:
+                chain.append(parent)
+                parent = self.parent.get(parent)
+            self.ancestors[addr] = tuple(chain)
+
+        self._ancestor_sets = {}
+        descendants = dict((addr, set()) for addr in self.parent)
+        for addr, chain in self.ancestors.items():
+            self._ancestor_sets[addr] = frozenset(chain)
+            for ancestor in chain:
+                descendants.setdefault(ancestor, set()).add(addr)
+        self.descendants = dict((addr, frozenset(devs))
+                                for addr, devs in descendants.items())
+
+        by_numa = {}
+        for addr, node in self.numa_node.items():
+            by_numa.setdefault(node, set()).add(addr)
+        self.by_numa = dict((node, frozenset(devs)) for node, devs in by_numa.items())
+
+    @staticmethod
+    def _read(path, name):
+        try:
+            with open(os.path.join(path, name)) as fh:
+                return fh.read().strip()
+        except IOError:
+            return None
+
+    @staticmethod
+    def _addr(addr):
+        if len(addr) == 7:
+            return "0000:" + addr
+        return addr
+
+    def devices(self):
+        return self.parent.keys()
+
+    def ancestorsOf(self, addr):
+        """ return the bridges above a device, nearest first"""
+        return list(self.ancestors[self._addr(addr)])
+
+    def descendantsOf(self, addr):
+        """ return the set of devices below a bridge"""
+        return self.descendants[self._addr(addr)]
+
+    def isAncestor(self, ancestor, addr):
+        return self._addr(ancestor) in self._ancestor_sets[self._addr(addr)]
+
+    def rootPort(self, addr):
+        """ return the top bridge above a device, or the device itself if
+        it is directly below the host bridge"""
+        addr = self._addr(addr)
+        chain = self.ancestors[addr]
+        return chain[-1] if chain else addr
+
+    def numaNode(self, addr):
+        """ return the NUMA node of a device, None if unknown"""
+        return self.numa_node.get(self._addr(addr))
+
+    def localCpus(self, addr):
+        return self.local_cpus.get(self._addr(addr), frozenset())
+
+    def onNode(self, node):
+        """ return the set of devices of a NUMA node"""
+        return self.by_numa.get(node, frozenset())
+
+    def sameNuma(self, addr1, addr2):
+        node = self.numaNode(addr1)
+        return node is not None and node == self.numaNode(addr2)
 
 def pci_sbdfi_to_nic(sbdfi, nics):
     match = VALID_SBDFI.match(sbdfi)
@@ -23,18 +23,64 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
+import bz2
+import hashlib
+import marshal
 import md5
+import operator
+import os
 import os.path
+import sqlite3
+import tempfile
+import threading
+import time
 import xml.dom.minidom
+import xml.parsers.expat
 import ConfigParser
+import Queue
+import StringIO
+import zlib
 
+import xcp.accessor as accessor
+import xcp.logger as logger
+import xcp.parallel as parallel
 import xcp.version as version
 import xcp.xmlunwrap as xmlunwrap
 
-class Package:
-    pass
+def _intern(value):
+    """ Intern strings repeated across many packages. """
+    if type(value) is str:
+        return intern(value)
+    return value
+
+class Package(object):
+    """ Base of the packages of a Repository.  Packages use slots, and keep
+    their md5sum in binary form, as catalogs may hold many thousands. """
+
+    __slots__ = ('repository', 'label', 'size', '_md5', 'filename')
+
+    def _get_md5sum(self):
+        return binascii.hexlify(self._md5)
+
+    def _set_md5sum(self, md5sum):
+        try:
+            self._md5 = binascii.unhexlify(md5sum)
+        except TypeError, e:
+            raise ValueError("invalid md5sum %r: %s" % (md5sum, e))
+        if len(self._md5) != 16:
+            raise ValueError("invalid md5sum %r" % md5sum)
+
+    md5sum = property(_get_md5sum, _set_md5sum)
+
+    def open(self, threaded = False):
+        """ Open the package file for reading, verifying its size and md5sum
+        as it is read.  See Repository.openPackage(). """
+        return self.repository.openPackage(self, threaded)
 
 class BzippedPackage(Package):
+    __slots__ = ('optional', 'destination')
+
     def __init__(self, repository, label, size, md5sum, optional, fname, root):
         (
             self.repository,
@@ -44,12 +90,15 @@ class BzippedPackage(Package):
             self.optional,
             self.filename,
             self.destination
-            ) = ( repository, label, long(size), md5sum, (optional==True), fname, root )
+            ) = ( repository, label, int(size), md5sum, (optional==True), fname,
+                  _intern(root) )
 
     def __repr__(self):
         return "<BzippedPackage '%s'>" % self.label
 
 class RPMPackage(Package):
+    __slots__ = ('optional', 'options')
+
     def __init__(self, repository, label, size, md5sum, optional, fname, options):
         (
             self.repository,
@@ -59,12 +108,15 @@ class RPMPackage(Package):
             self.optional,
             self.filename,
             self.options
-            ) = ( repository, label, long(size), md5sum, (optional==True), fname, options )
+            ) = ( repository, label, int(size), md5sum, (optional==True), fname,
+                  _intern(options) )
 
     def __repr__(self):
         return "<RPMPackage '%s'>" % self.label
 
 class DriverRPMPackage(RPMPackage):
+    __slots__ = ('kernel',)
+
     def __init__(self, repository, label, size, md5sum, fname, kernel, options):
         (
             self.repository,
@@ -74,12 +126,15 @@ class DriverRPMPackage(RPMPackage):
             self.filename,
             self.kernel,
             self.options
-            ) = ( repository, label, long(size), md5sum, fname, kernel, options )
+            ) = ( repository, label, int(size), md5sum, fname, _intern(kernel),
+                  _intern(options) )
 
     def __repr__(self):
         return "<DriverRPMPackage '%s', kernel '%s'>" % (self.label, self.kernel)
 
 class DriverPackage(Package):
+    __slots__ = ('destination',)
+
     def __init__(self, repository, label, size, md5sum, fname, root):
         (
             self.repository,
@@ -88,12 +143,14 @@ class DriverPackage(Package):
             self.md5sum,
             self.filename,
             self.destination
-            ) = ( repository, label, long(size), md5sum, fname, root )
+            ) = ( repository, label, int(size), md5sum, fname, _intern(root) )
 
     def __repr__(self):
         return "<DriverPackage '%s'>" % self.label
 
 class FirmwarePackage(Package):
+    __slots__ = ()
+
     def __init__(self, repository, label, size, md5sum, fname):
         (
             self.repository,
@@ -101,17 +158,348 @@ class FirmwarePackage(Package):
             self.size,
             self.md5sum,
             self.filename
-            ) = ( repository, label, long(size), md5sum, fname )
+            ) = ( repository, label, int(size), md5sum, fname )
 
     def __repr__(self):
         return "<FirmwarePackage '%s'>" % self.label
 
+class YumPackage(object):
+    """ A package listed in the primary metadata of a Yum repository. """
+
+    fields = ('name', 'epoch', 'version', 'release', 'arch', 'size',
+              'checksum', 'checksum_type', 'location')
+    __slots__ = fields
+
+    def __init__(self, name, epoch, version, release, arch, size,
+                 checksum, checksum_type, location):
+        (
+            self.name,
+            self.epoch,
+            self.version,
+            self.release,
+            self.arch,
+            self.size,
+            self.checksum,
+            self.checksum_type,
+            self.location
+            ) = ( name, _intern(epoch), version, release, _intern(arch), int(size),
+                  checksum, _intern(checksum_type), location )
+
+    @property
+    def evr(self):
+        evr = "%s-%s" % (self.version, self.release)
+        if self.epoch and self.epoch != '0':
+            evr = "%s:%s" % (self.epoch, evr)
+        return evr
+
+    def __repr__(self):
+        return "<YumPackage '%s-%s.%s'>" % (self.name, self.evr, self.arch)
+
 class NoRepository(Exception):
     pass
 
 class RepoFormatError(Exception):
     pass
 
+class VerifyError(Exception):
+    pass
+
+def _checkFilename(fname):
+    """ Return the normalised package file name 'fname', raising
+    RepoFormatError if it is absolute or leaves the repository. """
+    try:
+        return accessor.relativeName(fname)
+    except ValueError:
+        raise RepoFormatError("%s: package file name outside the repository" % fname)
+
+class VerifyingFile(object):
+    """ File wrapper checking the size and md5 digest of the data read
+    through it.  VerifyError is raised by the read() reaching end of file
+    if they do not match.
+
+    With threaded=True the digest is computed on a helper thread, so that
+    hashing overlaps with waiting for the next block of data. """
+
+    def __init__(self, fh, name, size, md5sum, threaded = False):
+        self.fh = fh
+        self.name = name
+        self.size = size
+        self.md5sum = md5sum.lower()
+        self.length = 0
+        self.checked = False
+        self.verified = False
+        self._error = None
+        self._md5 = hashlib.md5()
+        self._queue = None
+        self._thread = None
+        if threaded:
+            self._queue = Queue.Queue(maxsize = 8)
+            self._thread = threading.Thread(target = self._hasher)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _hasher(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self._md5.update(data)
+
+    def _stopHasher(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _verify(self):
+        self._stopHasher()
+        self.checked = True
+        digest = self._md5.hexdigest()
+        if self.length != self.size:
+            self._error = VerifyError("%s: size %d, expected %d" %
+                                      (self.name, self.length, self.size))
+        elif digest != self.md5sum:
+            self._error = VerifyError("%s: md5sum %s, expected %s" %
+                                      (self.name, digest, self.md5sum))
+        if self._error:
+            raise self._error
+        self.verified = True
+
+    def read(self, size = -1):
+        data = self.fh.read(size)
+        if data:
+            self.length += len(data)
+            if self._queue:
+                self._queue.put(data)
+            else:
+                self._md5.update(data)
+        eof = size < 0 or (size != 0 and not data)
+        if eof:
+            if not self.checked:
+                self._verify()
+            elif self._error:
+                # keep failing rather than reading as a clean end of file
+                raise self._error
+        return data
+
+    def close(self):
+        self._stopHasher()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _PackagesParser(object):
+    """ expat handler building the packages of an XS-PACKAGES file. """
+
+    def __init__(self, repo, packages):
+        self.repo = repo
+        self.packages = packages
+        self.attrs = None
+        self.text = []
+        self.depth = 0
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.returns_unicode = False
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse('', True)
+
+    def start(self, name, attrs):
+        if self.attrs is not None:
+            self.depth += 1
+        elif name == 'package':
+            self.attrs = attrs
+            self.text = []
+
+    def data(self, text):
+        # only the direct text of <package> is its file name
+        if self.attrs is not None and self.depth == 0:
+            self.text.append(text)
+
+    def end(self, name):
+        if self.attrs is None:
+            return
+        if self.depth > 0:
+            self.depth -= 1
+            return
+        self.packages.append(self.repo._create_package(self.attrs,
+                                                       ''.join(self.text)))
+        self.attrs = None
+
+class _RepomdParser(object):
+    """ expat handler extracting the revision and the primary metadata
+    entry of a repomd.xml file. """
+
+    def __init__(self):
+        self.revision = None
+        self.location = None
+        self.checksum = None
+        self.checksum_type = None
+        self.in_primary = False
+        self.stack = []
+        self.text = []
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.returns_unicode = False
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.text.append
+
+    def start(self, name, attrs):
+        self.stack.append(attrs)
+        del self.text[:]
+        if name == 'data':
+            self.in_primary = attrs.get('type') == 'primary'
+        elif name == 'location' and self.in_primary:
+            self.location = attrs.get('href')
+        elif name == 'checksum' and self.in_primary:
+            self.checksum_type = attrs.get('type')
+
+    def end(self, name):
+        self.stack.pop()
+        text = ''.join(self.text).strip()
+        if name == 'revision' and len(self.stack) == 1:
+            self.revision = text
+        elif name == 'checksum' and self.in_primary:
+            self.checksum = text
+        elif name == 'data':
+            self.in_primary = False
+
+class _PrimaryParser(object):
+    """ expat handler calling add(YumPackage) for each package of a
+    primary.xml file. """
+
+    def __init__(self, add):
+        self.add = add
+        self.pkg = None
+        self.depth = 0
+        self.text = []
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.returns_unicode = False
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.data
+
+    def start(self, name, attrs):
+        if self.pkg is None:
+            if name == 'package':
+                self.pkg = {}
+                self.depth = 0
+            return
+        self.depth += 1
+        del self.text[:]
+        if self.depth != 1:
+            return
+        if name == 'version':
+            self.pkg['epoch'] = attrs.get('epoch', '0')
+            self.pkg['version'] = attrs.get('ver')
+            self.pkg['release'] = attrs.get('rel')
+        elif name == 'size':
+            self.pkg['size'] = attrs.get('package', '0')
+        elif name == 'location':
+            self.pkg['location'] = attrs.get('href')
+        elif name == 'checksum':
+            self.pkg['checksum_type'] = attrs.get('type')
+
+    def data(self, text):
+        if self.pkg is not None and self.depth == 1:
+            self.text.append(text)
+
+    def end(self, name):
+        if self.pkg is None:
+            return
+        if self.depth == 0:
+            try:
+                self.add(YumPackage(**self.pkg))
+            except (TypeError, ValueError):
+                raise RepoFormatError, "Invalid package in primary metadata: %s" % str(self.pkg)
+            self.pkg = None
+            return
+        if self.depth == 1 and name in ('name', 'arch', 'checksum'):
+            self.pkg[name] = ''.join(self.text).strip()
+        self.depth -= 1
+
+class MetadataCache(object):
+    """ On-disk cache of parsed Repository metadata, keyed by the source of
+    the metadata and the md5 digest of its contents, so that unchanged
+    repositories can be reconstructed without parsing XS-PACKAGES.
+
+    Only the parse is saved: XS-REPOSITORY and XS-PACKAGES are still
+    transferred to compute the digest.  Entries are stored with marshal,
+    which is not safe against maliciously crafted data, so the directory
+    must only be writable by trusted users.  Once the entries take more
+    than max_bytes, the least recently used ones are removed. """
+
+    FORMAT = 1
+
+    max_bytes = 64 * 1024 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, source, digest):
+        key = hashlib.sha1("%s\0%s" % (source, digest)).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def load(self, source, digest):
+        path = self._path(source, digest)
+        try:
+            with open(path, 'rb') as f:
+                fmt, record = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if fmt != self.FORMAT:
+            return None
+        try:
+            # most recently used, as far as _prune() is concerned
+            os.utime(path, None)
+        except OSError:
+            pass
+        return record
+
+    def store(self, source, digest, record):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp = tempfile.NamedTemporaryFile(dir = self.directory,
+                                              delete = False)
+            tmp.write(marshal.dumps((self.FORMAT, record)))
+            tmp.close()
+            os.rename(tmp.name, self._path(source, digest))
+            self._prune()
+        except (IOError, OSError) as e:
+            logger.warning("Failed to cache metadata of %s: %s" % (source, e))
+
+    def _prune(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by another user of the cache
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
 class BaseRepository(object):
     """ Represents a repository containing packages and associated meta data. """
     def __init__(self, access, base = ""):
@@ -127,25 +515,41 @@ class BaseRepository(object):
             pass
         return repos
 
+    @classmethod
+    def findRepositoriesMany(cls, accessors, workers = 16):
+        """ Run findRepositories() on each of accessors using at most
+        'workers' threads.  Yields (accessor, repositories, exc_info) tuples
+        in completion order, exc_info being None on success. """
+        def find(access):
+            access.start()
+            try:
+                return cls.findRepositories(access)
+            finally:
+                access.finish()
+
+        return parallel.iterCompleted(find, accessors, workers)
+
     @classmethod
     def getRepoVer(cls, access):
+        # one session, so that the version is read from the files isRepo()
+        # cached
         access.start()
-        is_yum = YumRepository.isRepo(access, "")
-        access.finish()
-        
-        if is_yum:
-            return YumRepository.getRepoVer(access)
-        return Repository.getRepoVer(access)
+        try:
+            if YumRepository.isRepo(access, ""):
+                return YumRepository.getRepoVer(access)
+            return Repository.getRepoVer(access)
+        finally:
+            access.finish()
 
     @classmethod
     def getProductVersion(cls, access):
         access.start()
-        is_yum = YumRepository.isRepo(access, "")
-        access.finish()
-
-        if is_yum:
-            return YumRepository.getProductVersion(access)
-        return None
+        try:
+            if YumRepository.isRepo(access, ""):
+                return YumRepository.getProductVersion(access)
+            return None
+        finally:
+            access.finish()
 
 class YumRepository(BaseRepository):
     """ Represents a Yum repository containing packages and associated meta data. """
@@ -161,26 +565,185 @@ class YumRepository(BaseRepository):
             return []
         return [ YumRepository(access, "") ]
 
-    def __init__(self, access, base = ""):
+    PARSE_BUFSIZE = 64 * 1024
+
+    def __init__(self, access, base = "", index_dir = None):
+        """ If index_dir is given, the package list is stored there in
+        an sqlite database per repomd revision, so that it is only parsed
+        once and can be queried through an index. """
         BaseRepository.__init__(self, access, base)
+        self.index_dir = index_dir
+        self._packages = None
+        self._index = None
+
+    # key of the files read by isRepo() and the version queries in the
+    # session cache of the accessor, None standing for a missing file
+    _FILE_CACHE_KEY = 'yum-files'
+    _file_cache_lock = threading.Lock()
+
+    @classmethod
+    def _cachedFile(cls, access, name):
+        """ Return the contents of 'name', or None if it does not exist,
+        reading it only once per start()/finish() session of the
+        accessor. """
+        access.start()
+        try:
+            with cls._file_cache_lock:
+                files = access.session_cache.setdefault(cls._FILE_CACHE_KEY, {})
+                if name in files:
+                    return files[name]
+
+            try:
+                fh = access.openAddress(name)
+                contents = None
+                if fh:
+                    try:
+                        contents = fh.read()
+                    finally:
+                        fh.close()
+            except Exception as e:
+                # may be transient, so not remembered
+                logger.debug("Failed to read %s: %s" % (name, e))
+                return None
+
+            with cls._file_cache_lock:
+                files[name] = contents
+            return contents
+        finally:
+            access.finish()
 
     @classmethod
     def isRepo(cls, access, base):
         """ Return whether there is a repository at base address
         'base' accessible using accessor."""
-        return False not in map(lambda x: access.access(os.path.join(base, x)),
-                                [cls.TREEINFO_FILENAME, cls.REPOMD_FILENAME])
+        return all(cls._cachedFile(access, os.path.join(base, x)) is not None
+                   for x in [cls.TREEINFO_FILENAME, cls.REPOMD_FILENAME])
+
+    def _feed(self, parser, fh, decompress = None, digest = None):
+        try:
+            while True:
+                data = fh.read(self.PARSE_BUFSIZE)
+                if not data:
+                    break
+                if digest:
+                    digest.update(data)
+                if decompress:
+                    data = decompress.decompress(data)
+                parser.Parse(data, False)
+            if hasattr(decompress, 'flush'):
+                parser.Parse(decompress.flush(), False)
+            parser.Parse('', True)
+        except (xml.parsers.expat.ExpatError, zlib.error, IOError, EOFError), e:
+            raise RepoFormatError, "Failed to parse metadata: %s" % str(e)
+        finally:
+            fh.close()
+
+    def _open(self, name):
+        fh = self.access.openAddress(os.path.join(self.base, name))
+        if not fh:
+            raise RepoFormatError, "Failed to open %s" % name
+        return fh
+
+    def _readRepomd(self):
+        repomd = _RepomdParser()
+        self._feed(repomd.parser, self._open(self.REPOMD_FILENAME))
+        if not repomd.location:
+            raise RepoFormatError, "No primary metadata in %s" % self.REPOMD_FILENAME
+        return repomd
+
+    def _readPrimary(self, repomd, add):
+        """ Stream the (possibly compressed) primary metadata through the
+        parser, checking it against the checksum given in repomd.xml. """
+        if repomd.location.endswith('.gz'):
+            decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif repomd.location.endswith('.bz2'):
+            decompress = bz2.BZ2Decompressor()
+        else:
+            decompress = None
+        digest = None
+        if repomd.checksum_type in hashlib.algorithms:
+            digest = hashlib.new(repomd.checksum_type)
+        self._feed(_PrimaryParser(add).parser, self._open(repomd.location),
+                   decompress, digest)
+        if digest and digest.hexdigest() != repomd.checksum:
+            raise RepoFormatError, "Checksum mismatch for %s" % repomd.location
+
+    def _buildIndex(self, repomd, path):
+        tmp = tempfile.NamedTemporaryFile(dir = self.index_dir, delete = False)
+        tmp.close()
+        try:
+            db = sqlite3.connect(tmp.name)
+            db.execute("CREATE TABLE packages (%s)" % ', '.join(YumPackage.fields))
+            insert = "INSERT INTO packages VALUES (%s)" % ', '.join('?' * len(YumPackage.fields))
+            self._readPrimary(repomd, lambda pkg: db.execute(
+                insert, [getattr(pkg, f) for f in YumPackage.fields]))
+            db.execute("CREATE INDEX packages_name ON packages (name, arch)")
+            db.commit()
+            db.close()
+            os.rename(tmp.name, path)
+        except:
+            os.unlink(tmp.name)
+            raise
+
+    def _load(self):
+        self.access.start()
+        try:
+            repomd = self._readRepomd()
+            if not self.index_dir:
+                packages = []
+                self._readPrimary(repomd, packages.append)
+                self._packages = packages
+                return
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
+            key = hashlib.sha1("%r:%s:%s:%s" % (self.access, self.base, repomd.revision,
+                                                repomd.checksum)).hexdigest()
+            path = os.path.join(self.index_dir, key + ".sqlite")
+            if not os.path.exists(path):
+                self._buildIndex(repomd, path)
+            self._index = path
+        finally:
+            self.access.finish()
+
+    def findPackages(self, name = None, arch = None):
+        """ Return the packages matching the given name and/or arch. """
+        if self._packages is None and self._index is None:
+            self._load()
+        if self._packages is not None:
+            return [p for p in self._packages
+                    if (name is None or p.name == name) and
+                    (arch is None or p.arch == arch)]
+
+        clauses = []
+        params = []
+        for field, value in (('name', name), ('arch', arch)):
+            if value is not None:
+                clauses.append("%s = ?" % field)
+                params.append(value)
+        query = "SELECT * FROM packages"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        db = sqlite3.connect(self._index)
+        db.text_factory = str
+        try:
+            return [YumPackage(*row) for row in db.execute(query, params)]
+        finally:
+            db.close()
+
+    @property
+    def packages(self):
+        return self.findPackages()
 
     @classmethod
     def _getVersion(cls, access, category):
         category_map = {'platform': 'platform_version', 'branding': 'product_version'}
 
-        access.start()
         try:
-            treeinfofp = access.openAddress(cls.TREEINFO_FILENAME)
+            contents = cls._cachedFile(access, cls.TREEINFO_FILENAME)
+            if contents is None:
+                raise IOError("not found")
             treeinfo = ConfigParser.SafeConfigParser()
-            treeinfo.readfp(treeinfofp)
-            treeinfofp.close()
+            treeinfo.readfp(StringIO.StringIO(contents), cls.TREEINFO_FILENAME)
             if treeinfo.has_section('system-v1'):
                 ver_str = treeinfo.get('system-v1', category_map[category])
             else:
@@ -189,7 +752,6 @@ class YumRepository(BaseRepository):
 
         except Exception, e:
             raise RepoFormatError, "Failed to open %s: %s" % (cls.TREEINFO_FILENAME, str(e))
-        access.finish()
         return repo_ver
 
     @classmethod
@@ -216,14 +778,18 @@ class Repository(BaseRepository):
 
     OPER_MAP = {'eq': ' = ', 'ne': ' != ', 'lt': ' < ', 'gt': ' > ', 'le': ' <= ', 'ge': ' >= '}
 
+    repo_attrs = ('originator', 'name', 'product', 'version', 'build')
+
+    PARSE_BUFSIZE = 64 * 1024
+
     @classmethod
-    def findRepositories(cls, access):
+    def _packageLocations(cls, access):
+        """ Return the locations which may hold a repository.  The accessor
+        must have been started. """
         # Check known locations:
         package_list = ['', 'packages', 'packages.main', 'packages.linux',
                         'packages.site']
-        repos = []
 
-        access.start()
         try:
             extra = access.openAddress(cls.REPOLIST_FILENAME)
             if extra:
@@ -232,42 +798,375 @@ class Repository(BaseRepository):
                 extra.close()
         except Exception, e:
             raise RepoFormatError, "Failed to open %s: %s" % (cls.REPOLIST_FILENAME, str(e))
+        return package_list
 
-        for loc in package_list:
-            if cls.isRepo(access, loc):
-                repos.append(Repository(access, loc))
-        access.finish()
+    @classmethod
+    def findRepositories(cls, access, lazy = False):
+        access.start()
+        try:
+            package_list = cls._packageLocations(access)
+
+            # probe all locations at once, then read the repositories found
+            workers = access.max_transfers
+            probes = [(loc, fn) for loc in package_list
+                      for fn in (cls.REPOSITORY_FILENAME, cls.PKGDATA_FILENAME)]
+            found = parallel.mapOrdered(
+                lambda probe: access.access(os.path.join(*probe)),
+                probes, workers)
+            locations = [loc for i, loc in enumerate(package_list)
+                         if found[2 * i] and found[2 * i + 1]]
+            repos = parallel.mapOrdered(lambda loc: Repository(access, loc, lazy = lazy),
+                                        locations, workers)
+        finally:
+            access.finish()
         return repos
 
-    def __init__(self, access, base, is_group = False):
+    # MetadataCache used when none is passed to the constructor
+    metadata_cache = None
+
+    def __init__(self, access, base, is_group = False, cache = None, lazy = False):
+        """ Read the repository at base address 'base'.  With lazy=True only
+        XS-REPOSITORY is read here, XS-PACKAGES being read and parsed when
+        packages is first used. """
         BaseRepository.__init__(self, access, base)
         self.is_group = is_group
         self._md5 = md5.new()
         self.requires = []
-        self.packages = []
+        self._packages = None
+        self._packages_lock = threading.Lock()
+        if cache is None:
+            cache = self.metadata_cache
+        self._cache = cache
 
         access.start()
-
         try:
-            repofile = access.openAddress(os.path.join(base, self.REPOSITORY_FILENAME))
-        except Exception, e:
+            repofile_contents = self._read_metadata(self.REPOSITORY_FILENAME)
+            # kept to key the cache entry of the packages
+            self._repofile_contents = repofile_contents if cache else None
+            self._parse_repofile(StringIO.StringIO(repofile_contents))
+            if not lazy:
+                self._load_packages()
+        finally:
             access.finish()
-            raise NoRepository, e
-        self._parse_repofile(repofile)
-        repofile.close()
 
+    def __repr__(self):
+        return "<Repository '%s', version '%s'>" % (self.identifier, self.product_version)
+
+    def _read_metadata(self, fname):
         try:
-            pkgfile = access.openAddress(os.path.join(base, self.PKGDATA_FILENAME))
+            fh = self.access.openAddress(os.path.join(self.base, fname))
         except Exception, e:
-            access.finish()
             raise NoRepository, e
-        self._parse_packages(pkgfile)
-        pkgfile.close()
-
-        access.finish()
-
-    def __repr__(self):
-        return "<Repository '%s', version '%s'>" % (self.identifier, self.product_version)
+        if not fh:
+            raise NoRepository, "%s: accessor error %s" % (fname, self.access.lastError)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def _get_packages(self):
+        if self._packages is None:
+            self._load_packages()
+        return self._packages
+
+    def _set_packages(self, packages):
+        self._packages = packages
+
+    packages = property(_get_packages, _set_packages)
+
+    def _load_packages(self):
+        with self._packages_lock:
+            if self._packages is not None:
+                return
+            # parse into copies so that readers never see a partial list
+            packages = []
+            digest = self._md5.copy()
+            self.access.start()
+            try:
+                if self._cache:
+                    self._load_cached(self._cache,
+                                      self._read_metadata(self.PKGDATA_FILENAME),
+                                      packages, digest)
+                else:
+                    try:
+                        pkgfile = self.access.openAddress(
+                            os.path.join(self.base, self.PKGDATA_FILENAME))
+                    except Exception, e:
+                        raise NoRepository, e
+                    if not pkgfile:
+                        raise NoRepository, "%s: accessor error %s" % (
+                            self.PKGDATA_FILENAME, self.access.lastError)
+                    self._parse_packages(pkgfile, packages, digest)
+            finally:
+                self.access.finish()
+            self._md5 = digest
+            self._packages = packages
+
+    def _load_cached(self, cache, pkgfile_contents, packages, digest):
+        source = "%r:%s" % (self.access, self.base)
+        key = md5.new(self._repofile_contents + pkgfile_contents).hexdigest()
+        record = cache.load(source, key)
+        if record:
+            digest.update(pkgfile_contents)
+            self._restore(record, packages)
+            return
+        self._parse_packages(StringIO.StringIO(pkgfile_contents), packages, digest)
+        cache.store(source, key, self._record(packages))
+
+    # package attributes holding constructor_map arguments
+    package_fields = {'label': 'label', 'size': 'size', 'md5': 'md5sum',
+                      'optional': 'optional', 'fname': 'filename',
+                      'root': 'destination', 'options': 'options',
+                      'kernel': 'kernel'}
+
+    def _record(self, packages):
+        """ Return 'packages' as plain data for MetadataCache. """
+        ptypes = dict((v[0], k) for k, v in self.constructor_map.items())
+        records = []
+        for pkg in packages:
+            ptype = ptypes[pkg.__class__]
+            records.append((ptype, tuple(getattr(pkg, self.package_fields[f])
+                                          for f in self.constructor_map[ptype][1])))
+        return {'packages': records}
+
+    def _restore(self, record, packages):
+        for ptype, args in record['packages']:
+            packages.append(self.constructor_map[ptype][0](self, *args))
+
+    def openPackage(self, pkg, threaded = False):
+        """ Return a VerifyingFile for package 'pkg' of this repository,
+        or False if the accessor failed to open it.  The accessor must have
+        been started. """
+        fh = self.access.openAddress(os.path.join(self.base, pkg.filename))
+        if not fh:
+            return False
+        return VerifyingFile(fh, pkg.filename, pkg.size, pkg.md5sum, threaded)
+
+    @staticmethod
+    def _matches(path, pkg):
+        """ Return whether the local file 'path' has the size and md5sum of
+        'pkg'. """
+        try:
+            if os.path.getsize(path) != pkg.size:
+                return False
+            digest = hashlib.md5()
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(Repository.PARSE_BUFSIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+        except (IOError, OSError):
+            return False
+        return digest.hexdigest() == pkg.md5sum.lower()
+
+    def _fetchPackage(self, pkg, dest):
+        path = os.path.join(dest, _checkFilename(pkg.filename))
+        if self._matches(path, pkg):
+            return 'skipped'
+        self.access.makeParent(path)
+        in_fh = self.openPackage(pkg, threaded = True)
+        if not in_fh:
+            raise IOError("%s: accessor error %s" %
+                          (pkg.filename, self.access.lastError))
+        tmp = path + ".part"
+        out_fh = open(tmp, 'wb')
+        try:
+            self.access.copyFile(in_fh, out_fh)
+            os.rename(tmp, path)
+        except:
+            out_fh.close()
+            os.unlink(tmp)
+            raise
+        finally:
+            in_fh.close()
+        return 'fetched'
+
+    def fetch(self, dest, packages = None, workers = None, progress = None):
+        """ Copy packages (by default all those of the repository) below the
+        local directory 'dest', verifying their size and md5sum as they are
+        transferred.  Files already present with the expected contents are
+        not transferred again.
+
+        progress, if given, is called as progress(pkg, status, done, total)
+        as each package completes, status being 'fetched', 'skipped' or
+        'failed'.  Returns the list of packages which could not be fetched. """
+
+        if packages is None:
+            packages = self.packages
+        packages = list(packages)
+        failed = []
+        transferred = 0
+        start = time.time()
+
+        self.access.start()
+        try:
+            for done, (pkg, status, exc_info) in enumerate(parallel.iterCompleted(
+                    lambda pkg: self._fetchPackage(pkg, dest), packages,
+                    self.access.transferWorkers(workers))):
+                if exc_info:
+                    logger.error("Failed to fetch %s: %s" % (pkg.filename, exc_info[1]))
+                    status = 'failed'
+                    failed.append(pkg)
+                elif status == 'fetched':
+                    transferred += pkg.size
+                if progress:
+                    progress(pkg, status, done + 1, len(packages))
+        finally:
+            self.access.finish()
+
+        logger.info("Fetched %d of %d packages, %s" %
+                    (len(packages) - len(failed), len(packages),
+                     accessor.TransferStats.summary(transferred, time.time() - start)))
+        return failed
+
+    # directory below a synchronised repository in which the packages are
+    # staged until they can all be swapped in
+    SYNC_STAGING_DIR = ".xs-sync"
+
+    def _stagingName(self, fname):
+        return os.path.join(self.base, self.SYNC_STAGING_DIR, fname)
+
+    def _syncPackage(self, pkg, dest):
+        in_fh = self.openPackage(pkg, threaded = True)
+        if not in_fh:
+            raise IOError("%s: accessor error %s" %
+                          (pkg.filename, self.access.lastError))
+        try:
+            dest.writeFile(in_fh, self._stagingName(pkg.filename))
+        finally:
+            in_fh.close()
+
+    def _unstage(self, dest, fnames):
+        for fname in fnames:
+            try:
+                dest.remove(self._stagingName(fname))
+            except Exception as e:
+                logger.debug("Failed to remove staged %s: %s" % (fname, e))
+
+    def _removeStagingDirs(self, dest, fnames):
+        """ Remove the directories staging 'fnames', and SYNC_STAGING_DIR
+        itself, as far as they are empty. """
+        dirs = set()
+        for fname in fnames:
+            parent = os.path.dirname(os.path.normpath(fname))
+            while parent:
+                dirs.add(self._stagingName(parent))
+                parent = os.path.dirname(parent)
+        # children sort after their parents, so are removed first
+        for name in sorted(dirs, reverse = True) + [
+                os.path.join(self.base, self.SYNC_STAGING_DIR)]:
+            try:
+                dest.removeDir(name)
+            except Exception as e:
+                logger.debug("Failed to remove staging directory %s: %s" % (name, e))
+
+    def _readMetadata(self):
+        """ Return the contents of the metadata files, checking they are
+        still those the repository was built from. """
+        contents = []
+        for fname in (self.REPOSITORY_FILENAME, self.PKGDATA_FILENAME):
+            fh = self.access.openAddress(os.path.join(self.base, fname))
+            if not fh:
+                raise NoRepository("%s: accessor error %s" %
+                                   (fname, self.access.lastError))
+            try:
+                contents.append(fh.read())
+            finally:
+                fh.close()
+        if md5.new(''.join(contents)).hexdigest() != self._md5.hexdigest():
+            raise RepoFormatError("%s changed during synchronisation" % self)
+        return contents
+
+    def sync(self, dest, workers = None, progress = None):
+        """ Bring the copy of the repository reached through the writable
+        accessor 'dest' up to date, transferring only the packages absent
+        from its XS-PACKAGES or listed there with a different size or
+        md5sum.
+
+        Packages are copied and verified below SYNC_STAGING_DIR, which is
+        removed afterwards.  Only once all of them succeeded are they
+        renamed into place one by one, followed by XS-PACKAGES and then
+        XS-REPOSITORY, so readers may briefly see changed packages listed
+        with their old size and md5sum.  If any transfer fails the staged
+        packages are removed and the published copy is left untouched.
+        progress is as for fetch().  Returns the list of packages which
+        could not be transferred. """
+
+        if dest.read_only:
+            raise ValueError("Cannot synchronise %s to read-only %r" % (self, dest))
+        # before anything is staged or removed under these names
+        for pkg in self.packages:
+            _checkFilename(pkg.filename)
+
+        dest.start()
+        try:
+            current = {}
+            if Repository.isRepo(dest, self.base):
+                existing = Repository(dest, self.base)
+                if existing._md5.hexdigest() == self._md5.hexdigest():
+                    logger.info("%s is up to date" % existing)
+                    return []
+                current = dict((p.filename, (p.size, p.md5sum.lower()))
+                               for p in existing.packages)
+
+            packages = []
+            done = 0
+            total = len(self.packages)
+            for pkg in self.packages:
+                if current.get(pkg.filename) != (pkg.size, pkg.md5sum.lower()):
+                    packages.append(pkg)
+                else:
+                    done += 1
+                    if progress:
+                        progress(pkg, 'skipped', done, total)
+
+            failed = []
+            transferred = 0
+            start = time.time()
+            swapped = False
+            self.access.start()
+            try:
+                for pkg, _, exc_info in parallel.iterCompleted(
+                        lambda pkg: self._syncPackage(pkg, dest), packages,
+                        min(self.access.transferWorkers(workers), dest.transferWorkers(workers))):
+                    done += 1
+                    if exc_info:
+                        logger.error("Failed to transfer %s: %s" %
+                                     (pkg.filename, exc_info[1]))
+                        failed.append(pkg)
+                    else:
+                        transferred += pkg.size
+                    if progress:
+                        progress(pkg, 'failed' if exc_info else 'fetched', done, total)
+
+                logger.info("Transferred %d of %d packages, %s" %
+                            (len(packages) - len(failed), len(packages),
+                             accessor.TransferStats.summary(transferred,
+                                                            time.time() - start)))
+                if failed:
+                    return failed
+
+                repofile_contents, pkgfile_contents = self._readMetadata()
+                metadata = ((self.PKGDATA_FILENAME, pkgfile_contents),
+                            (self.REPOSITORY_FILENAME, repofile_contents))
+                for fname, contents in metadata:
+                    dest.writeFile(StringIO.StringIO(contents), self._stagingName(fname))
+
+                # everything is staged: swap it in
+                swapped = True
+                for fname in [pkg.filename for pkg in packages] + [m[0] for m in metadata]:
+                    dest.rename(self._stagingName(fname), os.path.join(self.base, fname))
+            finally:
+                self.access.finish()
+                staged = ([pkg.filename for pkg in packages] +
+                          [self.PKGDATA_FILENAME, self.REPOSITORY_FILENAME])
+                if not swapped:
+                    self._unstage(dest, staged)
+                self._removeStagingDirs(dest, staged)
+            return []
+        finally:
+            dest.finish()
 
     def __str__(self):
         out = "Repository '%s', version '%s'" % (self.identifier, self.product_version)
@@ -295,7 +1194,7 @@ class Repository(BaseRepository):
         try:
             repo_node = xmlunwrap.getElementsByTagName(xmldoc, ['repository'], mandatory = True)
 
-            attrs = ('originator', 'name', 'product', 'version', 'build')
+            attrs = self.repo_attrs
             optional_attrs = ('build')
 
             for attr in attrs:
@@ -316,28 +1215,38 @@ class Repository(BaseRepository):
         except:
             raise RepoFormatError, "%s format error" % self.REPOSITORY_FILENAME
 
+        self._set_identity()
+
+    def _set_identity(self):
         self.identifier = "%s:%s" % (self.originator, self.name)
         ver_str = self.version
         if self.build:
             ver_str += '-'+self.build
         self.product_version = version.Version.from_string(ver_str)
 
-    def _parse_packages(self, pkgfile):
-        pkgfile_contents = pkgfile.read()
-        pkgfile.close()
-
-        # update md5sum for repo
-        self._md5.update(pkgfile_contents)
-
-        # build xml doc object
+    def _parse_packages(self, pkgfile, packages = None, digest = None):
+        """ Parse package data incrementally, creating packages as their
+        element closes rather than building a DOM of the whole file.
+        Packages are appended to 'packages' and the data added to 'digest',
+        by default those of the repository. """
+
+        if packages is None:
+            packages = self._packages
+        if digest is None:
+            digest = self._md5
+        parser = _PackagesParser(self, packages)
         try:
-            xmldoc = xml.dom.minidom.parseString(pkgfile_contents)
-        except:
+            while True:
+                data = pkgfile.read(self.PARSE_BUFSIZE)
+                if not data:
+                    break
+                # update md5sum for repo
+                digest.update(data)
+                parser.feed(data)
+            parser.close()
+        except xml.parsers.expat.ExpatError:
             raise RepoFormatError, "%s not in XML" % self.PKGDATA_FILENAME
-
-        for pkg_node in xmlunwrap.getElementsByTagName(xmldoc, ['package']):
-            pkg = self._create_package(pkg_node)
-            self.packages.append(pkg)
+        pkgfile.close()
 
     constructor_map = {
         'tbz2': [ BzippedPackage, ( 'label', 'size', 'md5', 'optional', 'fname', 'root' ) ],
@@ -350,15 +1259,26 @@ class Repository(BaseRepository):
 
     optional_attrs = ['optional', 'options']
 
-    def _create_package(self, node):
+    def _create_package(self, attrs, text):
+        """ Create a package from the attributes and text of its element,
+        missing and empty attributes being treated alike. """
+        ptype = attrs.get('type')
+        if ptype not in self.constructor_map:
+            raise RepoFormatError, "%s: invalid package type %s" % (self.PKGDATA_FILENAME, ptype)
         args = [ self ]
-        ptype = xmlunwrap.getStrAttribute(node, ['type'], mandatory = True)
         for attr in self.constructor_map[ptype][1]:
             if attr == 'fname':
-                args.append(xmlunwrap.getText(node))
+                args.append(text.strip())
+            elif attrs.get(attr):
+                args.append(attrs[attr])
+            elif attr in self.optional_attrs:
+                args.append('')
             else:
-                args.append(xmlunwrap.getStrAttribute(node, [attr], mandatory = attr not in self.optional_attrs))
-        return self.constructor_map[ptype][0](*args)
+                raise RepoFormatError, "%s: missing attribute %s" % (self.PKGDATA_FILENAME, attr)
+        try:
+            return self.constructor_map[ptype][0](*args)
+        except ValueError, e:
+            raise RepoFormatError, "%s format error: %s" % (self.PKGDATA_FILENAME, str(e))
 
     @classmethod
     def isRepo(cls, access, base):
@@ -369,15 +1289,93 @@ class Repository(BaseRepository):
 
     @classmethod
     def getRepoVer(cls, access):
+        """ Return the version of the xcp:main repository, reading only the
+        XS-REPOSITORY file of each location. """
+        def probe(loc):
+            try:
+                return Repository(access, loc, lazy = True)
+            except NoRepository:
+                return None
+
         repo_ver = None
 
+        access.start()
         try:
-            repos = cls.findRepositories(access)
-            for r in repos:
-                if r.identifier == cls.XCP_MAIN_IDENT:
+            locations = cls._packageLocations(access)
+            for r in parallel.mapOrdered(probe, locations, access.max_transfers):
+                if r and r.identifier == cls.XCP_MAIN_IDENT:
                     repo_ver = r.product_version
                     break
         except:
             pass
+        finally:
+            access.finish()
 
         return repo_ver
+
+class RepositoryIndex(object):
+    """ Lookup tables over the packages of a set of repositories, and
+    evaluation of their requirements against each other. """
+
+    def __init__(self, repos):
+        self.repos = list(repos)
+        self.by_identifier = {}
+        self.by_label = {}
+        self.by_type = {}
+        self.by_kernel = {}
+        self.requirements = []
+
+        ptypes = dict((v[0], k) for k, v in Repository.constructor_map.items())
+        for repo in self.repos:
+            self.by_identifier.setdefault(repo.identifier, []).append(repo)
+            for pkg in repo.packages:
+                self.by_label.setdefault(pkg.label, []).append(pkg)
+                self.by_type.setdefault(ptypes[pkg.__class__], []).append(pkg)
+                kernel = getattr(pkg, 'kernel', None)
+                if kernel:
+                    self.by_kernel.setdefault(kernel, []).append(pkg)
+            for req in repo.requires:
+                ver_str = req['version']
+                if req.get('build'):
+                    ver_str += '-' + req['build']
+                self.requirements.append(
+                    (repo, req, "%s:%s" % (req['originator'], req['name']),
+                     version.Constraint(req['test'], ver_str)))
+
+    def findPackages(self, label = None, ptype = None, kernel = None):
+        """ Return the packages matching all the criteria given. """
+        criteria = [(index, key) for index, key in
+                    ((self.by_label, label), (self.by_type, ptype),
+                     (self.by_kernel, kernel)) if key is not None]
+        if not criteria:
+            return [pkg for repo in self.repos for pkg in repo.packages]
+        matches = [index.get(key, []) for index, key in criteria]
+        smallest = min(matches, key = len)
+        others = [set(map(id, m)) for m in matches if m is not smallest]
+        return [pkg for pkg in smallest
+                if all(id(pkg) in other for other in others)]
+
+    def satisfies(self, identifier, constraint):
+        """ Return the repositories of the set providing identifier with a
+        version satisfying constraint. """
+        return [repo for repo in self.by_identifier.get(identifier, [])
+                if constraint(repo.product_version)]
+
+    def unsatisfied(self):
+        """ Return (repository, requirement) for each requirement not met
+        by any repository of the set. """
+        by_identifier = {}
+        for requirement in self.requirements:
+            by_identifier.setdefault(requirement[2], []).append(requirement)
+
+        failed = set()
+        for identifier, requirements in by_identifier.items():
+            results = version.satisfying(
+                [constraint for _, _, _, constraint in requirements],
+                self.by_identifier.get(identifier, []),
+                key = operator.attrgetter('product_version'))
+            for requirement, repos in zip(requirements, results):
+                if not repos:
+                    failed.add(id(requirement))
+        return [requirement[:2] for requirement in self.requirements
+                if id(requirement) in failed]
@@ -25,10 +25,51 @@
 
 """version - version comparison methods"""
 
-class Version:
+import bisect
+import collections
+import functools
+import operator
+import threading
+
+class Version(object):
+    """ A version number: integer (or string) arcs and an optional build
+    identifier.
+
+    Versions compare and hash on their arcs only, through the tuple 'key'
+    computed on construction, which may also be passed straight to sorted()
+    as in sorted(versions, key = attrgetter('key')).  A subclass overriding
+    arc_cmp() or ver_cmp() gets a key ordered by them instead.  Instances
+    returned by from_string() may be shared, so 'ver' and 'build' are
+    read-only. """
+
+    __slots__ = ('_ver', '_build', 'key')
+
+    # number of strings whose parsed Versions from_string() keeps
+    CACHE_SIZE = 1024
+
+    _cache = collections.OrderedDict()
+    _cache_lock = threading.Lock()
+
     def __init__(self, ver, build = None):
-        self.ver = ver
-        self.build = build
+        self._ver = tuple(ver)
+        self._build = build
+        self.key = self._makeKey(self._ver)
+
+    @property
+    def ver(self):
+        return list(self._ver)
+
+    @property
+    def build(self):
+        return self._build
+
+    @classmethod
+    def _makeKey(cls, arcs):
+        if (cls.arc_cmp.__func__ is Version.arc_cmp.__func__ and
+            cls.ver_cmp.__func__ is Version.ver_cmp.__func__):
+            return arcs
+        return functools.cmp_to_key(
+            lambda l, r: cls.ver_cmp(list(l), list(r)))(arcs)
 
     @staticmethod
     def intify(x):
@@ -45,7 +86,18 @@ class Version:
         where:
 
         p.q. ... y.z are integer arcs
-        b is a build identifier"""
+        b is a build identifier
+
+        Recently parsed strings return the same instance. """
+
+        cache_key = (cls, ver_str)
+        with cls._cache_lock:
+            v = cls._cache.get(cache_key)
+            if v is not None:
+                # most recently used last
+                del cls._cache[cache_key]
+                cls._cache[cache_key] = v
+                return v
 
         build = None
 
@@ -54,13 +106,18 @@ class Version:
 
         ver = map(cls.intify, ver_str.split('.'))
 
-        return cls(ver, build)
+        v = cls(ver, build)
+        with cls._cache_lock:
+            cls._cache[cache_key] = v
+            if len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last = False)
+        return v
 
     def ver_as_string(self):
-        return '.'.join(map(str, self.ver))
+        return '.'.join(map(str, self._ver))
 
     def build_as_string(self):
-        return self.build if self.build else ''
+        return self._build if self._build else ''
 
     def __str__(self):
         build = self.build_as_string()
@@ -68,6 +125,9 @@ class Version:
             return self.ver_as_string() + '-' + build
         return self.ver_as_string()
 
+    def __repr__(self):
+        return "<Version '%s'>" % self
+
     #************************************************************
     #
     # NOTE: Comparisons are performed as follows
@@ -76,6 +136,10 @@ class Version:
     #
     # Build identifiers are ignored.
     #
+    # The keys follow arc_cmp() and ver_cmp(), which subclasses may
+    # override.  Versions comparing equal through them should have equal
+    # arcs, which the hash is computed from.
+    #
     #************************************************************
 
     @classmethod
@@ -96,20 +160,100 @@ class Version:
         # equal to this point, down to list length
         return (len(l) - len(r))
 
+    def __hash__(self):
+        return hash(self._ver)
+
     def __eq__(self, v):
-        return self.ver_cmp(self.ver, v.ver) == 0
+        if not isinstance(v, Version):
+            return NotImplemented
+        return self.key == v.key
 
     def __ne__(self, v):
-        return self.ver_cmp(self.ver, v.ver) != 0
+        if not isinstance(v, Version):
+            return NotImplemented
+        return self.key != v.key
 
     def __lt__(self, v):
-        return self.ver_cmp(self.ver, v.ver) < 0
+        return self.key < v.key
 
     def __gt__(self, v):
-        return self.ver_cmp(self.ver, v.ver) > 0
+        return self.key > v.key
 
     def __le__(self, v):
-        return self.ver_cmp(self.ver, v.ver) <= 0
+        return self.key <= v.key
 
     def __ge__(self, v):
-        return self.ver_cmp(self.ver, v.ver) >= 0
+        return self.key >= v.key
+
+class Constraint(object):
+    """ A requirement on versions, such as the 'ge' 8.2.0 of a repository's
+    <requires>, compiled into a predicate on sort keys.  Like Version
+    comparisons, builds are ignored. """
+
+    __slots__ = ('test', 'version', 'match')
+
+    TESTS = {'eq': operator.eq, 'ne': operator.ne, 'lt': operator.lt,
+             'gt': operator.gt, 'le': operator.le, 'ge': operator.ge}
+
+    def __init__(self, test, ver):
+        """ test is one of TESTS, ver a Version or a version string. """
+        if test not in self.TESTS:
+            raise ValueError("invalid version test %r" % test)
+        if not isinstance(ver, Version):
+            ver = Version.from_string(ver)
+        self.test = test
+        self.version = ver
+
+        compare = self.TESTS[test]
+        key = ver.key
+        self.match = lambda v: compare(v.key, key)
+
+    def __call__(self, v):
+        return self.match(v)
+
+    def __repr__(self):
+        return "<Constraint %s %s>" % (self.test, self.version)
+
+    def ranges(self, keys):
+        """ Return the (start, stop) index ranges of the sorted list of
+        version keys 'keys' satisfying the constraint. """
+        key = self.version.key
+        if self.test in ('eq', 'ne', 'le', 'gt'):
+            right = bisect.bisect_right(keys, key)
+        if self.test in ('eq', 'ne', 'lt', 'ge'):
+            left = bisect.bisect_left(keys, key)
+
+        if self.test == 'eq':
+            return [(left, right)]
+        if self.test == 'ne':
+            return [(0, left), (right, len(keys))]
+        if self.test == 'lt':
+            return [(0, left)]
+        if self.test == 'le':
+            return [(0, right)]
+        if self.test == 'gt':
+            return [(right, len(keys))]
+        return [(left, len(keys))]
+
+def satisfying(constraints, candidates, key = None):
+    """ Return, for each of constraints, the list of candidates satisfying
+    it, in ascending version order.  key(candidate) gives the Version of a
+    candidate, candidates being Versions by default.
+
+    The candidates are sorted once, each constraint then costing a binary
+    search plus the size of its result. """
+    if key is None:
+        ordered = sorted(candidates, key = operator.attrgetter('key'))
+        keys = [v.key for v in ordered]
+    else:
+        decorated = sorted(((key(c).key, i, c) for i, c in enumerate(candidates)))
+        keys = [k for k, _, _ in decorated]
+        ordered = [c for _, _, c in decorated]
+
+    results = []
+    for constraint in constraints:
+        matches = []
+        for start, stop in constraint.ranges(keys):
+            matches.extend(ordered[start:stop])
+        results.append(matches)
+    return results